@@ -1,2 +1,25 @@
-from .main import get_records, import_json_dict, report_file_path
-from .record import *
+import importlib
+import importlib.util
+
+
+MAIN_NAMES = ('get_records', 'import_json_dict', 'report_file_path')
+
+
+def __getattr__(name):
+    """Imports main and record on first use.
+
+    Importing main reads config.json, so the package itself stays cheap to
+    import and the bench can point USERADDDATA_HOME elsewhere first.
+    Submodules are left to the import system.
+    """
+    if name.startswith('_') or importlib.util.find_spec(
+            '%s.%s' % (__name__, name)) is not None:
+        raise AttributeError(name)
+    main = importlib.import_module('.main', __name__)
+    if name in MAIN_NAMES:
+        return getattr(main, name)
+    record = importlib.import_module('.record', __name__)
+    if not hasattr(record, name):
+        raise AttributeError(
+            "module '%s' has no attribute '%s'" % (__name__, name))
+    return getattr(record, name)
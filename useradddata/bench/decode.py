@@ -0,0 +1,67 @@
+import sys
+import time
+import random
+from .. import decoding
+
+
+def make_records(rows, raw_columns=20, text_columns=10, seed=0):
+    """Builds report rows shaped like the Oracle json exports"""
+    rnd = random.Random(seed)
+    words = ['Trunk', 'Stock', 'Ülm', 'São Paulo', 'Zürich', '', 'GEHC']
+    recs = []
+    for idx in range(rows):
+        rec = {}
+        for col in range(raw_columns):
+            value = ' '.join(rnd.choice(words) for x in range(3))
+            rec['Attribute_%d' % col] = {
+                'name': 'Raw_%d' % col,
+                'type': 'RAW',
+                'value': None if idx % 17 == col else value.encode(
+                    'utf8').hex()}
+        for col in range(text_columns):
+            rec['Attribute_%d' % (raw_columns + col)] = {
+                'name': 'Text_%d' % col,
+                'type': 'VARCHAR2',
+                'value': str(rnd.randint(0, 10 ** 6))}
+        recs.append(rec)
+    return recs
+
+
+def best_of(function, repeat):
+    times = []
+    for x in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def decode_by_block(recs, block_size):
+    """Decodes the way iter_json_dict does, one block at a time"""
+    rows = []
+    for idx in range(0, len(recs), block_size):
+        rows.extend(decoding.decode_rows(recs[idx:idx + block_size]))
+    return rows
+
+
+def run(rows=50000, repeat=3, block_size=decoding.DECODE_BLOCK_SIZE):
+    recs = make_records(rows)
+    by_row = [decoding.decode_row(x) for x in recs]
+    by_column = decode_by_block(recs, block_size)
+    if by_row != by_column:
+        raise RuntimeError('Column decoding differs from row decoding')
+    row_time = best_of(
+        lambda: [decoding.decode_row(x) for x in recs], repeat)
+    column_time = best_of(
+        lambda: decode_by_block(recs, block_size), repeat)
+    print('%d rows x %d cells, blocks of %d' % (
+        rows, len(recs[0]), block_size))
+    print('row by row:       %.3fs (%d rows/s)' % (
+        row_time, rows / row_time))
+    print('column by column: %.3fs (%d rows/s)' % (
+        column_time, rows / column_time))
+    print('speedup: %.1fx' % (row_time / column_time))
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,308 @@
+import re
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from .reports import fake_id, seed_records
+
+
+ID_PREFIXES = {
+    'User': '005',
+    'PermissionSetAssignment': '0Pa',
+    'SVMXC__Site__c': 'a0L',
+    'SVMXC__Service_Group_Members__c': 'a0M',
+    'SVMXC__Product_Stock__c': 'a0P',
+    'SVMXC__Product_Serial__c': 'a0Q'}
+REFERENCES = {
+    'ProfileId': 'Profile',
+    'ManagerId': 'User',
+    'UserRoleId': 'UserRole',
+    'AssigneeId': 'User',
+    'PermissionSetId': 'PermissionSet',
+    'SVMXC__Service_Engineer__c': 'User',
+    'GEHC_LS_Tech_Owner_Reference__c': 'User',
+    'SVMXC__Salesforce_User__c': 'User',
+    'SVMXC__Inventory_Location__c': 'SVMXC__Site__c',
+    'SVMXC__Location__c': 'SVMXC__Site__c',
+    'SVMXC__Service_Group__c': 'SVMXC__Service_Group__c',
+    'SVMXC__Preferred_Business_Hours__c': 'BusinessHours',
+    'SVMXC__Working_Hours__c': 'BusinessHours',
+    'SVMXC__Product__c': 'Product2',
+    'SVMXC__Product_Stock__c': 'SVMXC__Product_Stock__c'}
+NUMBERS = ['SVMXC__Quantity2__c']
+RELATIONSHIPS = {
+    'SVMXC__Product_Serial__r': (
+        'SVMXC__Product_Serial__c', 'SVMXC__Product_Stock__c')}
+QUOTED = r"'((?:[^'\\]|\\.)*)'"
+CONDITION = re.compile(
+    r"(\w+)\s*(=|\bIN\b)\s*(\(\s*%s(?:\s*,\s*%s)*\s*\)|%s)" % (
+        QUOTED, QUOTED, QUOTED), re.I)
+SUBQUERY = re.compile(r',?\s*\(SELECT [^)]* FROM (\w+)\)', re.I)
+STATEMENT = re.compile(
+    r'SELECT (.+?) FROM (\w+)(?: WHERE (.+))?$', re.I | re.S)
+
+
+def unquote(value):
+    return value.replace("\\'", "'").replace('\\\\', '\\')
+
+
+def same(field, left, right):
+    if left is None or right is None:
+        return left is right
+    if field.lower() == 'id' or field in REFERENCES:
+        return str(left)[:15] == str(right)[:15]
+    return str(left).lower() == str(right).lower()
+
+
+def get_value(row, field):
+    for key, value in row.items():
+        if key.lower() == field.lower():
+            return value
+    return None
+
+
+class FakeOrg():
+    """In-memory records answering the REST calls a run makes"""
+    def __init__(self, records=None, booleans=None):
+        self.records = seed_records() if records is None else records
+        self.booleans = set() if booleans is None else set(booleans)
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def describe(self, sobject, fields):
+        """Every field a space may send, typed the way the org would"""
+        described = []
+        for name in sorted(set(fields)):
+            soap_type = 'xsd:string'
+            if name == 'Id' or name in REFERENCES:
+                soap_type = 'tns:ID'
+            elif name in self.booleans:
+                soap_type = 'xsd:boolean'
+            elif name in NUMBERS:
+                soap_type = 'xsd:double'
+            described.append({
+                'name': name,
+                'soapType': soap_type,
+                'nillable': True,
+                'calculated': False,
+                'restrictedPicklist': False,
+                'picklistValues': [],
+                'referenceTo': [REFERENCES.get(name, sobject)],
+                'length': 255})
+        return {'name': sobject, 'fields': described}
+
+    def query(self, statement):
+        children = SUBQUERY.findall(statement)
+        statement = SUBQUERY.sub('', statement)
+        match = STATEMENT.match(statement.strip())
+        fields = [x.strip() for x in match.group(1).split(',')]
+        sobject = match.group(2)
+        conditions = []
+        for field, op, given in [
+                (x.group(1), x.group(2), x.group(3))
+                for x in CONDITION.finditer(match.group(3) or '')]:
+            conditions.append(
+                (field, [unquote(x) for x in re.findall(QUOTED, given)]))
+        with self.lock:
+            rows = [
+                x for x in self.records.get(sobject, [])
+                if all(any(same(f, get_value(x, f), v) for v in values)
+                       for f, values in conditions)]
+            found = []
+            for row in rows:
+                rtn = {'attributes': {'type': sobject}}
+                rtn.update({x: get_value(row, x) for x in fields})
+                for relationship in children:
+                    child, parent_field = RELATIONSHIPS[relationship]
+                    records = [
+                        dict(x) for x in self.records.get(child, [])
+                        if same('Id', x.get(parent_field, None), row['Id'])]
+                    rtn[relationship] = None if len(records) == 0 else {
+                        'totalSize': len(records),
+                        'done': True,
+                        'records': records}
+                found.append(rtn)
+        return {'totalSize': len(found), 'done': True, 'records': found}
+
+    def insert(self, sobject, payload):
+        with self.lock:
+            self.counter += 1
+            sfid = fake_id(ID_PREFIXES.get(sobject, 'a00'), self.counter)
+            record = {
+                k: v for k, v in payload.items() if k != 'attributes'}
+            record['Id'] = sfid
+            self.records.setdefault(sobject, []).append(record)
+        return {'id': sfid, 'success': True, 'errors': []}
+
+    def update(self, sobject, sfid, payload):
+        with self.lock:
+            for record in self.records.get(sobject, []):
+                if same('Id', record['Id'], sfid):
+                    record.update({
+                        k: v for k, v in payload.items()
+                        if k not in ['attributes', 'Id']})
+                    return {'id': record['Id'], 'success': True, 'errors': []}
+        return {'id': sfid, 'success': False, 'errors': [
+            {'message': 'entity is deleted', 'statusCode': 'NOT_FOUND'}]}
+
+
+class FakeForceHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_limit_info()
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_limit_info(self):
+        self.send_header('Sforce-Limit-Info', 'api-usage=%d/%d' % (
+            self.server.used(), self.server.daily_limit))
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length).decode('utf8') or '{}')
+
+    def route(self):
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        parts = [x for x in url.path.split('/') if x != '']
+        return (parts[3:], parse_qs(url.query))
+
+    def do_GET(self):
+        parts, query = self.route()
+        org = self.server.org
+        if parts[:1] == ['query']:
+            self.server.count('query')
+            return self.send_json(org.query(query['q'][0]))
+        if parts[:1] == ['search']:
+            self.server.count('search')
+            return self.send_json({'searchRecords': []})
+        if parts[:1] == ['limits']:
+            self.server.count('limits')
+            return self.send_json({'DailyApiRequests': {
+                'Max': self.server.daily_limit,
+                'Remaining': self.server.daily_limit - self.server.used()}})
+        if parts[:1] == ['sobjects'] and parts[-1:] == ['describe']:
+            self.server.count('describe')
+            return self.send_json(org.describe(
+                parts[1], self.server.fields.get(parts[1], [])))
+        self.server.count('other')
+        self.send_json([{'errorCode': 'NOT_FOUND'}], 404)
+
+    def do_POST(self):
+        parts, query = self.route()
+        body = self.read_json()
+        if parts[:2] == ['composite', 'sobjects']:
+            self.server.count('collection')
+            return self.send_json([
+                self.server.org.insert(x['attributes']['type'], x)
+                for x in body['records']])
+        self.server.count('insert')
+        self.send_json(self.server.org.insert(parts[1], body), 201)
+
+    def do_PATCH(self):
+        parts, query = self.route()
+        body = self.read_json()
+        if parts[:2] == ['composite', 'sobjects']:
+            self.server.count('collection')
+            return self.send_json([
+                self.server.org.update(x['attributes']['type'], x['Id'], x)
+                for x in body['records']])
+        self.server.count('update')
+        self.server.org.update(parts[1], parts[2], body)
+        self.send_response(204)
+        self.send_limit_info()
+        self.end_headers()
+
+
+class FakeForce(ThreadingHTTPServer):
+    """Local stand-in for the Salesforce REST endpoints a run calls.
+
+    fields maps an sobject to the field names its describe returns. Every
+    request waits latency seconds, and calls counts requests by kind.
+    Responses report usage against daily_limit the way the org does.
+    """
+    daemon_threads = True
+
+    def __init__(self, org, fields, latency=0.0, port=0,
+                 daily_limit=1000000):
+        super(FakeForce, self).__init__(('127.0.0.1', port), FakeForceHandler)
+        self.org = org
+        self.fields = fields
+        self.latency = latency
+        self.daily_limit = daily_limit
+        self.calls = Counter()
+        self.calls_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def count(self, kind):
+        with self.calls_lock:
+            self.calls[kind] += 1
+
+    def used(self):
+        with self.calls_lock:
+            return sum(self.calls.values())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class LocalResponse():
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = {} if headers is None else headers
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class LocalConnection():
+    """force.Connection stand-in that talks to a FakeForce server"""
+    def __init__(self, instance_url):
+        self.auth = {'instance_url': instance_url, 'access_token': 'bench'}
+
+    def request(self, method, url, payload=None):
+        data = None if payload is None else json.dumps(payload).encode()
+        req = urllib.request.Request(url, data=data, method=method)
+        req.add_header('Content-Type', 'application/json')
+        req.add_header(
+            'Authorization', 'Bearer %s' % self.auth['access_token'])
+        try:
+            with urllib.request.urlopen(req) as response:
+                return LocalResponse(
+                    response.status,
+                    response.read().decode('utf8'),
+                    dict(response.headers))
+        except urllib.error.HTTPError as e:
+            return LocalResponse(
+                e.code, e.read().decode('utf8'), dict(e.headers))
+
+    def req_get(self, url):
+        return self.request('GET', url).json()
+
+    def req_post(self, url, payload):
+        return self.request('POST', url, payload).json()
+
+    def req_patch(self, url, payload):
+        return self.request('PATCH', url, payload)
@@ -0,0 +1,108 @@
+"""Times a whole run against a local fake Salesforce.
+
+    python -m useradddata.bench.flow [users] [latency_ms] [workers]
+
+Synthetic reports and config.json are written to a temp folder, which
+becomes USERADDDATA_HOME for the run before main is imported, so the
+package's own config.json is neither needed nor read, and saved rules and
+queued decisions stay out of the package.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+from .fakeforce import FakeForce, FakeOrg, LocalConnection
+from .reports import BENCH_ENV, write_reports
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def describe_fields(report_fields):
+    """Field names the fake describes, by sobject, and the boolean ones"""
+    from ..spaces import user, site, tech, stock
+    fields = {
+        'User': [x for x in user.USER_DEFAULTS.keys()] + user.FIELDS_FROM_REF,
+        'PermissionSetAssignment': ['AssigneeId', 'PermissionSetId'],
+        'SVMXC__Site__c': [x for x in site.LOCN_DEFAULTS.keys()] + [
+            x for x in report_fields if x != 'SITE_USE_ID'] + [
+            'Name', 'Oracle_Sub_Inventory__c'],
+        'SVMXC__Service_Group_Members__c': [
+            x for x in tech.TECH_DEFAULTS.keys()] + [
+            'Name', 'SVMXC__Service_Group__c', 'SVMXC__Service_Territory__c',
+            'SVMXC__Email__c', 'Global_Region__c', 'Global_Sub_Region__c'],
+        'SVMXC__Product_Stock__c': [
+            x for x in stock.STOCK_DEFAULTS.keys()] + [
+            'SVMXC__Product__c', 'SVMXC__Quantity2__c'],
+        'SVMXC__Product_Serial__c': [
+            x for x in stock.SER_STOCK_DEFAULTS.keys()] + ['Name']}
+    fields = {k: ['Id'] + v for k, v in fields.items()}
+    booleans = set()
+    for defaults in [user.USER_DEFAULTS, site.LOCN_DEFAULTS,
+                     tech.TECH_DEFAULTS, stock.STOCK_DEFAULTS,
+                     stock.SER_STOCK_DEFAULTS]:
+        booleans.update(
+            [k for k, v in defaults.items() if isinstance(v, bool)])
+    return (fields, booleans)
+
+
+def run(users=200, latency_ms=0, workers=4):
+    folder = tempfile.mkdtemp(prefix='useradddata-bench-')
+    os.environ['USERADDDATA_HOME'] = folder
+    os.makedirs(os.path.join(folder, 'validation_rules'))
+    config = write_reports(folder, users)
+    # main reads config.json when first imported, so only import it now
+    from .. import main
+    from ..configurator import Config
+    from ..connections import register_connection
+    from ..decisions import DEFAULT_POLICY, DecisionPolicy, set_policy
+    from ..reportstore import ReportStore
+    main.config = Config(**config)
+    main.report_store = ReportStore(
+        main.report_file_path,
+        main.import_json_dict,
+        streamer=main.iter_json_dict,
+        modes={k: v.mode for k, v in main.config.reports.items()})
+    set_policy(DecisionPolicy(**{**DEFAULT_POLICY, 'interactive': False}))
+    fields, booleans = describe_fields(
+        main.report_store.fields('locations'))
+    server = FakeForce(
+        FakeOrg(booleans=booleans), fields, latency_ms / 1000.0).start()
+    register_connection(BENCH_ENV, LocalConnection(server.url))
+    try:
+        start = time.perf_counter()
+        records = main.get_records(workers)
+        built = time.perf_counter()
+        deferred = main.process_records(records)
+        done = time.perf_counter()
+    finally:
+        server.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+    calls = sum(server.calls.values())
+    print('%d Records, %d set aside, %dms latency, %d workers' % (
+        len(records), len(deferred), latency_ms, workers))
+    print('build:   %.2fs (%.1f Records/s)' % (
+        built - start, len(records) / (built - start)))
+    print('process: %.2fs (%.1f Records/s)' % (
+        done - built, len(records) / (done - built)))
+    print('REST calls: %d (%.1f per Record)' % (
+        calls, calls / max(len(records), 1)))
+    for kind, count in sorted(server.calls.items()):
+        print('  %-10s %d' % (kind, count))
+    peak = peak_rss_mb()
+    print('peak RSS: %s' % ('n/a' if peak is None else '%.0f MB' % peak))
+    return server.calls
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:]])
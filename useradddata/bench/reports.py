@@ -0,0 +1,150 @@
+import os
+import json
+import random
+
+
+BENCH_ENV = 'bench'
+BUSINESS_HOURS = 'GEHC LS Global Service Team Hours'
+PERMISSION_SETS = 3
+PRODUCTS = 400
+FIRST_NAMES = ['Ana', 'Bjørn', 'Chloé', 'Dev', 'Ewa', 'Farid', 'Grace']
+LAST_NAMES = ['Ng', 'Müller', 'Okafor', 'Silva', 'Tanaka', 'Ørsted']
+CITIES = ['Ulm', 'São Paulo', 'Zürich', 'Austin', 'Pune']
+RAW_COLUMNS = ('SVMXC__Street__c', 'SVMXC__City__c')
+
+
+def fake_id(prefix, number):
+    """18 character Id; the first 15 are unique per prefix and number"""
+    return '%s%012dAAA' % (prefix, number)
+
+
+def encode_row(row, raw=()):
+    """One row in the Oracle json export shape, RAW columns hex encoded"""
+    rec = {}
+    for idx, (name, value) in enumerate(row.items()):
+        cell = {'name': name, 'type': 'VARCHAR2', 'value': value}
+        if name in raw:
+            cell['type'] = 'RAW'
+            if value is not None:
+                cell['value'] = value.encode('utf8').hex()
+        rec['Attribute_%d' % idx] = cell
+    return rec
+
+
+def write_report(file_path, rows, raw=()):
+    folder = os.path.split(file_path)[0]
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(file_path, 'w') as f:
+        json.dump({'results': [encode_row(x, raw) for x in rows]}, f)
+    return file_path
+
+
+def seed_records():
+    """Records the fake org holds before a run, by sobject"""
+    return {
+        'BusinessHours': [
+            {'Id': fake_id('01m', 1), 'Name': BUSINESS_HOURS}],
+        'PermissionSet': [
+            {'Id': fake_id('0PS', x), 'Label': 'Bench set %d' % x}
+            for x in range(PERMISSION_SETS)],
+        'Profile': [{'Id': fake_id('00e', 1), 'Name': 'LS Service'}],
+        'UserRole': [{'Id': '00E80000001SQpuEAG', 'Name': 'LS Service'}],
+        'User': [{'Id': fake_id('005', 0), 'Username': 'manager@bench'}],
+        'SVMXC__Service_Group__c': [
+            {'Id': fake_id('a0S', 1), 'Name': 'Bench team'}],
+        'Product2': [
+            {'Id': fake_id('01t', x), 'Name': 'Product %d' % x}
+            for x in range(PRODUCTS)]}
+
+
+def location_rows(sites, rnd):
+    return [{
+        'Location_Number__c': 'L%05d' % x,
+        'Oracle_Ship_to_Number__c': 'S%05d' % x,
+        'Oracle_Location_ID__c': str(x),
+        'Operating_Unit__c': 'OU %d' % (x % 4),
+        'Source_Organization__c': 'ORG',
+        'SITE_USE_ID': str(100000 + x),
+        'SVMXC__Street__c': '%d Main St' % x,
+        'SVMXC__City__c': rnd.choice(CITIES),
+        'SVMXC__Zip__c': '%05d' % x,
+        'SVMXC__Country__c': 'United States'} for x in range(sites)]
+
+
+def stock_rows(sites, stock_per_site, serials_per_stock, rnd):
+    prod_stock = []
+    ser_stock = []
+    for site in range(sites):
+        products = rnd.sample(range(PRODUCTS), stock_per_site)
+        for product in products:
+            key = 'SUB%05d-%d' % (site, product)
+            prod_stock.append({
+                'Subinventory': 'SUB%05d' % site,
+                'key': key,
+                'SVMXC__Product__c': fake_id('01t', product),
+                'SVMXC__Quantity2__c': str(serials_per_stock)})
+            ser_stock.extend([{
+                'Key': key,
+                'Name': 'SN-%s-%d' % (key, x),
+                'OnHand': '1'} for x in range(serials_per_stock)])
+    return (prod_stock, ser_stock)
+
+
+def user_rows(users, sites, rnd):
+    rows = []
+    for x in range(users):
+        first = rnd.choice(FIRST_NAMES)
+        last = '%s%d' % (rnd.choice(LAST_NAMES), x)
+        rows.append({
+            'RECORD_ID': str(x),
+            'Environment': BENCH_ENV,
+            'Username': '%s.%s@bench' % (first, last),
+            'Alias': ('%s%s' % (first[0], last))[:8],
+            'CommunityNickname': '%s.%s' % (first, last),
+            'CurrencyIsoCode': 'USD',
+            'Email': '%s.%s@example.com' % (first, last),
+            'FederationIdentifier': str(500000000 + x),
+            'FirstName': first,
+            'Global_Region__c': 'Americas',
+            'Global_Sub_Region__c': 'North America',
+            'LanguageLocaleKey': 'en_US',
+            'LastName': last,
+            'LocaleSidKey': 'en_US',
+            'ManagerId': fake_id('005', 0),
+            'ProfileId': fake_id('00e', 1),
+            'SSO__c': str(500000000 + x),
+            'Territory__c': 'T%d' % (x % 10),
+            'TimeZoneSidKey': 'America/Chicago',
+            'ServiceTeam': fake_id('a0S', 1),
+            'Oracle_Location_Number': 'L%05d' % (x % sites),
+            'Oracle_SubInventory': 'SUB%05d' % (x % sites),
+            'PS1_PSID': fake_id('0PS', x % PERMISSION_SETS)})
+    return rows
+
+
+def write_reports(folder, users=100, sites=None, stock_per_site=20,
+                  serials_per_stock=2, seed=0):
+    """Writes the four reports and a config.json pointing at them.
+
+    Each user gets a site of their own unless sites is smaller. Returns
+    the config as a dict.
+    """
+    rnd = random.Random(seed)
+    sites = users if sites is None else sites
+    prod_stock, ser_stock = stock_rows(
+        sites, min(stock_per_site, PRODUCTS), serials_per_stock, rnd)
+    reports = {
+        'locations': (location_rows(sites, rnd), 'snapshot', RAW_COLUMNS),
+        'prod_stock': (prod_stock, 'snapshot', ()),
+        'ser_stock': (ser_stock, 'snapshot', ()),
+        'user_adds': (user_rows(users, sites, rnd), 'memory', ())}
+    config = {'reports_dir': folder, 'reports': {}, 'results': {
+        'user_adds': {'sub_dir': 'user_adds', 'file': 'result.json'}}}
+    for name, (rows, mode, raw) in reports.items():
+        write_report(os.path.join(folder, name, '%s.json' % name), rows, raw)
+        config['reports'][name] = {
+            'sub_dir': name, 'file': '%s.json' % name, 'mode': mode}
+    with open(os.path.join(folder, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=3)
+    return config
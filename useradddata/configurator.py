@@ -1,5 +1,7 @@
 import os
 import json
+from .decisions import get_policy
+from .paths import data_folder
 
 
 DEFAULT_CONFIG = {
@@ -8,15 +10,18 @@ DEFAULT_CONFIG = {
     "reports": {
         "locations": {
             "sub_dir": "All Locations",
-            "file": "All Subinventory Locations_1050720.json"
+            "file": "All Subinventory Locations_1050720.json",
+            "mode": "snapshot"
         },
         "prod_stock": {
             "sub_dir": "All Product Stock",
-            "file": "All Product Stock_1050723.json"
+            "file": "All Product Stock_1050723.json",
+            "mode": "snapshot"
         },
         "ser_stock": {
             "sub_dir": "All Serialized Stock",
-            "file": "All Subinventory Locations_1050720.json"
+            "file": "All Subinventory Locations_1050720.json",
+            "mode": "snapshot"
         },
         "user_adds": {
             "sub_dir": "Open User Adds",
@@ -48,7 +53,7 @@ def update_config(config):
 
 
 def config_file_path():
-    folder = os.path.split(__file__)[0]
+    folder = data_folder()
     file_path = os.path.join(folder, 'config.json')
     if not os.path.isfile(file_path):
         config = Config(**DEFAULT_CONFIG).to_dict()
@@ -62,11 +67,15 @@ class Config():
         self.reports = self.make_configinfos(kwargs.get('reports', None))
         self.results = self.make_configinfos(kwargs.get('results', None))
         self.reports_dir = kwargs.get('reports_dir', [])
+        self.api_limits = kwargs.get('api_limits', {})
         self.validate_dir()
 
     def validate_dir(self):
         if not os.path.isdir(self.reports_dir):
-            build_path = input('Enter directory: ')
+            build_path = get_policy().value(
+                'reports_dir',
+                {'reports_dir': self.reports_dir},
+                lambda: input('Enter directory: '))
             if not os.path.isdir(build_path):
                 raise RuntimeError("Invalid directory given")
             self.reports_dir = build_path
@@ -83,7 +92,8 @@ class Config():
         return {
             'reports_dir': self.reports_dir,
             'reports': {k: v.to_dict() for k, v in self.reports.items()},
-            'results': {k: v.to_dict() for k, v in self.results.items()}}
+            'results': {k: v.to_dict() for k, v in self.results.items()},
+            'api_limits': self.api_limits}
 
 
 class ConfigInfo():
@@ -91,11 +101,13 @@ class ConfigInfo():
         self.name = name
         self.sub_dir = kwargs.get('sub_dir', '')
         self.file = kwargs.get('file', '')
+        self.mode = kwargs.get('mode', 'memory')
 
     def to_dict(self):
         return {
             'sub_dir': self.sub_dir,
-            'file': self.file}
+            'file': self.file,
+            'mode': self.mode}
 
 
 if __name__ == '__main__':
@@ -0,0 +1,66 @@
+import threading
+import force as sf
+
+
+_connections = {}
+_envs = {}
+_lock = threading.Lock()
+_auth_lock = threading.Lock()
+
+
+def format_env(given):
+    return ''.join(given.split(' ')).lower()
+
+
+def get_connection(env):
+    """Shared force connection for an environment, authenticated once.
+
+    Connections that failed to authenticate are not kept, so the next call
+    tries again.
+    """
+    env = format_env(env)
+    with _lock:
+        conn = _connections.get(env, None)
+        if conn is None:
+            conn = sf.Connection(env)
+            if 'error' not in conn.auth.keys():
+                _connections[env] = conn
+                _envs[id(conn)] = env
+        return conn
+
+
+def register_connection(env, conn):
+    """Uses conn for every later get_connection(env)"""
+    env = format_env(env)
+    with _lock:
+        _connections[env] = conn
+        _envs[id(conn)] = env
+    return conn
+
+
+def connection_env(conn):
+    """Environment a shared connection was made for, or None"""
+    return _envs.get(id(conn), None)
+
+
+def reauthenticate(conn, stale_auth):
+    """Signs conn in again when its session expired, in place.
+
+    Records keep a reference to the shared connection, so its auth is
+    replaced rather than the connection. stale_auth is the auth the failed
+    call used; when another thread already replaced it, nothing is done.
+    Returns whether conn holds a fresh session.
+    """
+    env = connection_env(conn)
+    if env is None:
+        return False
+    with _auth_lock:
+        if conn.auth is not stale_auth:
+            return True
+        fresh = sf.Connection(env)
+        if 'error' in fresh.auth.keys():
+            print("%s could not sign in again: %s" % (
+                env, fresh.auth.get('error_description', '')))
+            return False
+        conn.auth = fresh.auth
+    return True
@@ -0,0 +1,161 @@
+import os
+import json
+import threading
+from datetime import datetime
+from . import metrics
+from .paths import data_folder
+
+
+DEFAULT_POLICY = {
+    "interactive": True,
+    "queue_file": "decision_queue.jsonl",
+    "rules": {
+        "choose_match": [
+            {"equal": "Username", "when": {"sobject": "User"}},
+            {"equal": "SSO__c", "when": {"sobject": "User"}},
+            {"equal": "Name", "when": {"sobject": "SVMXC__Site__c"}},
+            {"equal": "Name",
+             "when": {"sobject": "SVMXC__Service_Group_Members__c"}}
+        ],
+        "choose_site": [
+            {"equal": "Location_Number__c", "to": "Oracle_Location_Number"}
+        ],
+        "fix_value": [],
+        "reports_dir": []
+    }
+}
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def policy_file_path():
+    folder = data_folder()
+    file_path = os.path.join(folder, 'decisions.json')
+    if not os.path.isfile(file_path):
+        with open(file_path, 'w') as f:
+            json.dump(DEFAULT_POLICY, f, indent=3)
+    return file_path
+
+
+def get_policy():
+    global _policy
+    with _policy_lock:
+        if _policy is None:
+            with open(policy_file_path(), 'r') as f:
+                _policy = DecisionPolicy(**json.load(f))
+        return _policy
+
+
+def set_policy(policy):
+    global _policy
+    if not isinstance(policy, DecisionPolicy):
+        raise TypeError('Expected a DecisionPolicy object.')
+    with _policy_lock:
+        _policy = policy
+    return policy
+
+
+def option_value(option, field):
+    if isinstance(option, dict):
+        return option.get(field, None)
+    return getattr(option, field, None)
+
+
+class DecisionDeferred(RuntimeError):
+    def __init__(self, point, context):
+        self.point = point
+        self.context = context
+        super(DecisionDeferred, self).__init__(
+            'No rule decided %s; queued for review.' % point)
+
+
+class DecisionPolicy():
+    """Resolves the choices that used to stop a run at input().
+
+    rules maps a decision point to rules tried in order. A rule applies
+    when every "when" item equals the decision's context. Choice rules are
+    {"equal": field, "to": context_field} (the one option whose field equals
+    the context's), {"only": true} (the single option), {"first": true} and
+    {"none": true}; value rules are {"value": value}. Undecided points prompt
+    when interactive and are otherwise queued to queue_file.
+    """
+    def __init__(self, **kwargs):
+        self.interactive = kwargs.get('interactive', True)
+        self.queue_file = kwargs.get('queue_file', 'decision_queue.jsonl')
+        self.rules = kwargs.get('rules', {})
+        self.lock = threading.Lock()
+        self.prompt_lock = threading.Lock()
+
+    def applies(self, rule, context):
+        when = rule.get('when', {})
+        return all(context.get(k, None) == v for k, v in when.items())
+
+    def choose(self, point, options, context=None, prompt=None):
+        """Index of the chosen option, or None to choose none"""
+        context = {} if context is None else context
+        for rule in self.rules.get(point, []):
+            if not self.applies(rule, context):
+                continue
+            if rule.get('none', False):
+                return None
+            if rule.get('first', False) and len(options) > 0:
+                return 0
+            if rule.get('only', False) and len(options) == 1:
+                return 0
+            if 'equal' in rule:
+                wanted = context.get(rule.get('to', rule['equal']), None)
+                matched = [
+                    idx for idx, x in enumerate(options)
+                    if wanted is not None and
+                    option_value(x, rule['equal']) == wanted]
+                if len(matched) == 1:
+                    return matched[0]
+        if self.interactive and prompt is not None:
+            return self.ask(point, prompt)
+        self.defer(point, context, options)
+
+    def value(self, point, context=None, prompt=None, skip=False):
+        """Value for a free-text decision.
+
+        With skip, an undecided point is queued and None returned instead
+        of raising DecisionDeferred.
+        """
+        context = {} if context is None else context
+        for rule in self.rules.get(point, []):
+            if self.applies(rule, context) and 'value' in rule:
+                return rule['value']
+        if self.interactive and prompt is not None:
+            return self.ask(point, prompt)
+        if skip:
+            self.queue(point, context)
+            return None
+        self.defer(point, context)
+
+    def ask(self, point, prompt):
+        """Prompts one thread at a time, timing the wait for input"""
+        with self.prompt_lock:
+            with metrics.timer('input_wait_seconds', point=point):
+                return prompt()
+
+    def defer(self, point, context, options=None):
+        self.queue(point, context, options)
+        raise DecisionDeferred(point, context)
+
+    def queue_path(self):
+        if os.path.isabs(self.queue_file):
+            return self.queue_file
+        return os.path.join(data_folder(), self.queue_file)
+
+    def queue(self, point, context, options=None):
+        entry = {
+            'point': point,
+            'context': context,
+            'options': [
+                x if isinstance(x, dict) else x.to_dict()
+                for x in ([] if options is None else options)],
+            'queued': datetime.now().isoformat()}
+        with self.lock:
+            with open(self.queue_path(), 'a') as f:
+                f.write(json.dumps(entry, default=str) + '\n')
@@ -0,0 +1,123 @@
+import os
+import re
+from . import metrics
+from .jsonstream import iter_items
+
+
+HEX_WHITESPACE = re.compile(r'\s')
+DECODE_BLOCK_SIZE = 50
+
+
+def iter_json_dict(jsonfile, where=None, block_size=DECODE_BLOCK_SIZE):
+    """Streams decoded rows of a json file, keeping those where accepts"""
+    report = os.path.basename(jsonfile)
+    metrics.inc('report_bytes_read', os.path.getsize(jsonfile), report=report)
+    with open(jsonfile, 'r') as f:
+        block = []
+        for rec in iter_items(f, 'results'):
+            block.append(rec)
+            if len(block) < block_size:
+                continue
+            for row in timed_decode(block, report):
+                if where is None or where(row):
+                    yield row
+            block = []
+        for row in timed_decode(block, report):
+            if where is None or where(row):
+                yield row
+
+
+def timed_decode(block, report):
+    with metrics.timer('report_decode_seconds', report=report):
+        rows = decode_rows(block)
+    metrics.inc('report_rows_decoded', len(rows), report=report)
+    return rows
+
+
+def field_equals(field, value):
+    """Makes a where filter for iter_json_dict"""
+    return lambda row: field in row and row[field] == value
+
+
+def decode_row(rec):
+    rl = [decode_input(**v) for k, v in rec.items()]
+    return {x[0]: x[1] for x in rl if x is not None}
+
+
+def decode_rows(recs):
+    """Decodes rows column by column, giving the same output as decode_row.
+
+    Column names and types are read once per column, and RAW columns are
+    decoded with one fromhex call each. Blocks whose columns are not
+    uniform are decoded row by row.
+    """
+    if len(recs) == 0:
+        return []
+    keys = tuple(recs[0].keys())
+    if len(keys) == 0:
+        return [decode_row(x) for x in recs]
+    if any(tuple(x.keys()) != keys for x in recs):
+        return [decode_row(x) for x in recs]
+    names = []
+    columns = []
+    for key in keys:
+        cells = [x[key] for x in recs]
+        col_names, col_types, values = split_cells(cells)
+        col_names = set(col_names)
+        col_types = set(col_types)
+        if len(col_names) != 1 or len(col_types) != 1:
+            return [decode_row(x) for x in recs]
+        name = col_names.pop()
+        if name is None:
+            continue
+        if col_types.pop() == 'RAW':
+            values = decode_raw_column(values)
+        names.append(name)
+        columns.append(values)
+    if len(columns) == 0:
+        return [{} for x in recs]
+    return [dict(zip(names, x)) for x in zip(*columns)]
+
+
+def split_cells(cells):
+    """Splits a column's cells into names, types and values"""
+    return (
+        [x.get('name', None) for x in cells],
+        [x.get('type', 'VARCHAR2') for x in cells],
+        [x.get('value', None) for x in cells])
+
+
+def decode_raw_column(values):
+    """Decodes a column of RAW hex values with one fromhex call"""
+    present = [x for x in values if x is not None]
+    decoded = []
+    joined = '00'.join(present)
+    if (len(present) > 0 and
+            HEX_WHITESPACE.search(joined) is None and
+            all(len(x) % 2 == 0 for x in present)):
+        try:
+            decoded = bytes.fromhex(joined).decode('utf8').split('\x00')
+        except ValueError:
+            decoded = []
+    if len(decoded) != len(present):
+        # a value holds a NUL or bad hex; decode one by one as before
+        decoded = [bytes.fromhex(x).decode('utf8') for x in present]
+    if len(present) == len(values):
+        return decoded
+    decoded.reverse()
+    return ['' if x is None else decoded.pop() for x in values]
+
+
+def decode_input(**kwargs):
+    """decodes all RAW inputs to text"""
+    name = kwargs.get('name', None)
+    dtype = kwargs.get('type', 'VARCHAR2')
+    value = kwargs.get('value', None)
+    if name is None:
+        return None
+    if dtype == 'RAW':
+        if value is not None:
+            return (name, bytes.fromhex(value).decode('utf8'))
+        else:
+            return (name, '')
+    return (name, value)
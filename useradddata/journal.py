@@ -0,0 +1,133 @@
+import os
+import json
+import threading
+from datetime import datetime
+from .connections import format_env
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+class Journal():
+    """Append-only json lines of the actions and rows a run finished.
+
+    An action line holds the row, env, sobject and space key with what was
+    done, whether it succeeded and the sfid. A row line says whether every
+    space of the row succeeded. Reading keeps the last line for each.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.actions = {}
+        self.rows = {}
+        self.lock = threading.Lock()
+        self.file = None
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return self
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of a killed run may be cut short
+                    continue
+                self.remember(entry)
+        return self
+
+    def remember(self, entry):
+        if 'sobject' in entry:
+            key = (entry['row'], entry['env'], entry['sobject'], entry['key'])
+            self.actions[key] = entry
+        else:
+            self.rows[(entry['row'], entry['env'])] = entry
+
+    def open(self, resume=False):
+        """Appends to path, so a run never wipes an earlier checkpoint"""
+        if resume:
+            self.load()
+        self.file = open(self.path, 'a')
+        return self
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def append(self, entry):
+        entry['at'] = datetime.now().isoformat()
+        with self.lock:
+            self.remember(entry)
+            if self.file is not None:
+                self.file.write(json.dumps(entry) + '\n')
+                self.file.flush()
+
+    def note_action(self, space, done, success):
+        record = space.record
+        self.append({
+            'row': record.row_key(),
+            'env': format_env(record.ref.Environment),
+            'sobject': space.sobject,
+            'key': space.journal_key(),
+            'done': done,
+            'success': success,
+            'sfid': space.sfid})
+
+    def note_row(self, record, finished, roles):
+        self.append({
+            'row': record.row_key(),
+            'env': format_env(record.ref.Environment),
+            'finished': finished,
+            'roles': sorted(roles)})
+
+    def completed(self, record, space):
+        """The journaled success of space's action, or None"""
+        entry = self.actions.get((
+            record.row_key(),
+            format_env(record.ref.Environment),
+            space.sobject,
+            space.journal_key()), None)
+        if entry is None or not entry['success']:
+            return None
+        return entry
+
+    def row_finished(self, record):
+        entry = self.rows.get((
+            record.row_key(), format_env(record.ref.Environment)), None)
+        return entry is not None and entry['finished']
+
+    def finished_rows(self):
+        """(row, env) of every row whose spaces all succeeded"""
+        return set([k for k, v in self.rows.items() if v['finished']])
+
+
+def open_journal(path, resume=False):
+    """Starts journaling, reading path first when resuming"""
+    global _journal
+    journal = Journal(path).open(resume)
+    with _journal_lock:
+        if _journal is not None:
+            _journal.close()
+        _journal = journal
+    return journal
+
+
+def close_journal():
+    global _journal
+    with _journal_lock:
+        if _journal is not None:
+            _journal.close()
+        _journal = None
+
+
+def get_journal():
+    """The open journal, or None when the run is not journaled"""
+    return _journal
+
+
+def note_action(space, done, success):
+    journal = get_journal()
+    if journal is not None and space.record is not None:
+        journal.note_action(space, done, success)
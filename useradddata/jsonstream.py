@@ -0,0 +1,90 @@
+import json
+
+
+DECODER = json.JSONDecoder()
+WHITESPACE = ' \t\n\r'
+
+
+class JsonStream():
+    """Reads a json document piece by piece from an open text file.
+
+    Only the unread tail of the file is buffered, so a value is never held
+    in memory with more than one read chunk past its end.
+    """
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if chunk == '':
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while (self.pos < len(self.buffer) and
+                    self.buffer[self.pos] in WHITESPACE):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected "%s" but found "%s"' % (char, found))
+        self.pos += 1
+
+    def skip(self, char):
+        if self.peek() != char:
+            return False
+        self.pos += 1
+        return True
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.fill():
+                    continue
+                raise
+            if end == len(self.buffer) and self.fill():
+                # a number may continue into the next chunk
+                continue
+            self.pos = end
+            return value
+
+
+def iter_items(f, key='results'):
+    """Yields the items of the top-level array stored under key"""
+    stream = JsonStream(f)
+    stream.expect('{')
+    if stream.skip('}'):
+        return
+    while True:
+        name = stream.value()
+        stream.expect(':')
+        if name == key and stream.skip('['):
+            if not stream.skip(']'):
+                while True:
+                    yield stream.value()
+                    if not stream.skip(','):
+                        stream.expect(']')
+                        break
+        else:
+            stream.value()
+        if not stream.skip(','):
+            stream.expect('}')
+            return
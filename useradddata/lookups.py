@@ -0,0 +1,217 @@
+import re
+import time
+import threading
+import force as sf
+from . import querycache
+from . import ratelimit
+from .connections import connection_env
+
+
+MAX_KEYS = 200
+ID_PATTERN = re.compile(r'^[a-zA-Z0-9]{15}([a-zA-Z0-9]{3})?$')
+
+
+_loaders = {}
+_lock = threading.Lock()
+
+
+def quote(value):
+    return str(value).replace('\\', '\\\\').replace("'", "\\'")
+
+
+def is_id(value):
+    """Whether value could be a Salesforce Id: 15 or 18 alphanumerics"""
+    return isinstance(value, str) and ID_PATTERN.match(value) is not None
+
+
+def lookup_key(field, value):
+    """Ids match on their first 15 characters, other values ignore case"""
+    if value is None:
+        return None
+    if field.lower() == 'id':
+        return str(value)[:15]
+    return str(value).lower()
+
+
+def row_value(row, field):
+    if field in row:
+        return row[field]
+    for key, value in row.items():
+        if key.lower() == field.lower():
+            return value
+    return None
+
+
+class LookupLoader():
+    """Coalesces point lookups on one sobject field into IN queries.
+
+    Values announced with want are fetched together with the first load
+    that misses, in chunks of MAX_KEYS; a chunk that fails is retried one
+    value at a time. Malformed Ids are answered without a query. With a
+    window, a missing load waits that many seconds first so other threads
+    can add their values.
+    Results expire on the querycache TTLs; when the querycache is
+    invalidated for rows of the sobject, only their values are forgotten.
+    """
+    def __init__(self, conn, sobject, field, fields, window=0):
+        self.conn = conn
+        self.sobject = sobject
+        self.field = field
+        self.fields = [x for x in fields]
+        if field.lower() not in [x.lower() for x in self.fields]:
+            self.fields.append(field)
+        self.window = window
+        self.pending = {}
+        self.results = {}
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+
+    def want(self, value):
+        key = lookup_key(self.field, value)
+        if key is None:
+            return
+        with self.lock:
+            entry = self.results.get(key, None)
+            if entry is not None and querycache.is_live(entry[0]):
+                return
+            if self.field.lower() == 'id' and not is_id(value):
+                # a malformed Id would fail the whole IN query it joins
+                self.results[key] = (querycache.expires(self.sobject, []), [])
+            elif key not in self.pending:
+                self.pending[key] = value
+
+    def load(self, value):
+        key = lookup_key(self.field, value)
+        if key is None:
+            return []
+        with self.lock:
+            entry = self.results.get(key, None)
+        if entry is not None and querycache.is_live(entry[0]):
+            found = entry[1]
+            querycache.count('hits' if len(found) > 0 else 'negative_hits')
+        else:
+            if entry is not None:
+                querycache.count('expired')
+                with self.lock:
+                    self.results.pop(key, None)
+            querycache.count('misses')
+            self.want(value)
+            if self.window > 0:
+                time.sleep(self.window)
+            self.dispatch()
+            with self.lock:
+                found = self.results.get(key, (0, []))[1]
+        if isinstance(found, Exception):
+            raise found
+        return found
+
+    def dispatch(self):
+        with self.fetch_lock:
+            with self.lock:
+                values = [x for x in self.pending.values()]
+                self.pending = {}
+            for idx in range(0, len(values), MAX_KEYS):
+                self.fetch(values[idx:idx + MAX_KEYS])
+
+    def fetch(self, values):
+        keys = [lookup_key(self.field, x) for x in values]
+        try:
+            filters = ["%s IN ('%s')" % (
+                self.field, "','".join([quote(x) for x in values]))]
+            rows = ratelimit.limited(
+                self.conn, 'query', self.sobject, lambda: sf.SOQL(
+                    self.conn,
+                    fields=self.fields,
+                    sobject=self.sobject,
+                    filters=filters).get_results())
+        except Exception as e:
+            if len(values) > 1 and not isinstance(
+                    e, ratelimit.ApiLimitReached):
+                # one bad value fails the whole chunk; find it one by one
+                for value in values:
+                    self.fetch([value])
+                return
+            with self.lock:
+                for key in keys:
+                    self.results[key] = (0, e)
+            return
+        found = {}
+        for row in rows:
+            key = lookup_key(self.field, row_value(row, self.field))
+            found.setdefault(key, []).append(row)
+        with self.lock:
+            for key in keys:
+                matched = found.get(key, [])
+                self.results[key] = (
+                    querycache.expires(self.sobject, matched), matched)
+
+    def forget(self):
+        with self.lock:
+            self.results = {}
+
+    def forget_rows(self, rows):
+        """Drops the results for the values rows hold in field"""
+        keys = [
+            lookup_key(self.field, row_value(x, self.field)) for x in rows]
+        with self.lock:
+            for key in keys:
+                self.results.pop(key, None)
+
+
+def get_loader(conn, sobject, field, fields):
+    """Shared loader for (environment, sobject, field, fields)"""
+    env = connection_env(conn)
+    key = (
+        id(conn) if env is None else env,
+        sobject,
+        field.lower(),
+        tuple(fields))
+    with _lock:
+        loader = _loaders.get(key, None)
+        if loader is None:
+            loader = LookupLoader(conn, sobject, field, fields)
+            _loaders[key] = loader
+        return loader
+
+
+def load_one(conn, sobject, field, value, fields):
+    return get_loader(conn, sobject, field, fields).load(value)
+
+
+def want_one(conn, sobject, field, value, fields):
+    if conn is None:
+        return
+    get_loader(conn, sobject, field, fields).want(value)
+
+
+def dispatch_all(pool=None):
+    """Fetches everything announced with want but not loaded yet.
+
+    With an executor the loaders are dispatched on it without waiting.
+    """
+    with _lock:
+        loaders = [x for x in _loaders.values() if len(x.pending) > 0]
+    for loader in loaders:
+        if pool is None:
+            loader.dispatch()
+        else:
+            pool.submit(loader.dispatch)
+
+
+@querycache.on_invalidate
+def forget(env, sobject, rows=None):
+    """Drops loaded results for sobject in env after our own writes.
+
+    With rows only the values they hold are dropped, so lookups prefetched
+    for other Records survive.
+    """
+    with _lock:
+        loaders = [
+            v for k, v in _loaders.items()
+            if (env is None or k[0] == env) and
+            (sobject is None or k[1] == sobject)]
+    for loader in loaders:
+        if rows is None:
+            loader.forget()
+        else:
+            loader.forget_rows(rows)
@@ -1,15 +1,190 @@
 import os
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from . import lookups
+from . import metrics
+from . import ratelimit
 from .configurator import get_config
-from .record import Record
+from .connections import format_env
+from .decisions import DecisionDeferred
+from .decoding import (
+    DECODE_BLOCK_SIZE, decode_row, decode_rows, field_equals, iter_json_dict)
+from .journal import close_journal, open_journal
+from .jsonstream import iter_items
+from .plan import build_plan, load_plan, save_plan
+from .record import (
+    LazyRecord, Record, inspect_record, parse_row, report_row_key)
+from .reportstore import ReportStore
+from .results import ResultSink, RowResults, row_fingerprint
+from .validation import flush_force_defs
 
 
 config = get_config()
+ratelimit.configure(**config.api_limits)
 
 
-def get_records():
-    report = read_user_add_report()
-    return [Record(x) for x in report['results']]
+def get_records(workers=4):
+    return [x for x in iter_records(workers)]
+
+
+def iter_records(workers=4, max_pending=None, where=None):
+    """Builds Records on a thread pool and yields them in report order.
+
+    At most max_pending rows are in flight, so a slow consumer holds back
+    the report reader. Lookups the Records announce are fetched on the
+    same pool while later rows are still being built. Only raw rows where
+    accepts are built.
+    """
+    report_store.prepare()
+    max_pending = workers * 2 if max_pending is None else max_pending
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        idx = -1
+        for row in iter_user_add_report():
+            if where is not None and not where(row):
+                continue
+            idx += 1
+            pending.append(pool.submit(Record, row))
+            if (idx + 1) % max_pending == 0:
+                lookups.dispatch_all(pool)
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def row_env_key(values):
+    return (report_row_key(values), format_env(values.get('Environment', '')))
+
+
+def iter_lazy_records(offline=False):
+    """Yields LazyRecords, which build nothing until a space is used"""
+    for row in iter_user_add_report():
+        yield LazyRecord(row, offline)
+
+
+def inspect_report(offline=True):
+    """Prints the summary of every user add without Salesforce"""
+    count = 0
+    for record in iter_lazy_records(offline):
+        inspect_record(record)
+        count += 1
+    return count
+
+
+def process_records(records, deactivate_serials=False, on_done=None):
+    """Processes Records, setting aside those waiting on a decision.
+
+    With deactivate_serials, serials the report no longer holds are made
+    inactive. on_done is called with each Record once it is processed.
+    Returns the Records whose decisions were queued for review.
+    """
+    deferred = []
+    for record in records:
+        try:
+            record.process(deactivate_serials=deactivate_serials)
+        except DecisionDeferred as e:
+            print('Set aside %s: %s' % (record.user.get_name(), str(e)))
+            record.outcome = 'deferred'
+            deferred.append(record)
+        if on_done is not None:
+            on_done(record)
+    flush_force_defs()
+    write_metrics()
+    return deferred
+
+
+def journal_file_path():
+    base = os.path.splitext(result_file_path('user_adds'))[0]
+    return '%s.journal.jsonl' % base
+
+
+def result_stream_path():
+    base = os.path.splitext(result_file_path('user_adds'))[0]
+    return '%s.ndjson' % base
+
+
+def run_records(workers=4, deactivate_serials=False, resume=False,
+                path=None, incremental=True):
+    """Builds and processes the user adds, journaling what is done.
+
+    With resume, rows the journal has as finished are not built again, and
+    spaces it has as done keep their sfid instead of being matched and
+    sent again. When incremental, rows that finished in an earlier run and
+    have not changed since are skipped; the results file keeps each row's
+    fingerprint and outcome. Every processed Record's to_result is
+    streamed to result_stream_path as it finishes. Returns the Records set
+    aside.
+    """
+    path = journal_file_path() if path is None else path
+    journal = open_journal(path, resume)
+    results = RowResults(result_file_path('user_adds')).load()
+    sink = ResultSink(result_stream_path()).open()
+    finished = journal.finished_rows()
+
+    def wanted(row):
+        values = parse_row(row)
+        key = row_env_key(values)
+        if key in finished:
+            return False
+        return not incremental or not results.unchanged(
+            key[0], key[1], row_fingerprint(values))
+
+    def note(record):
+        results.note(
+            record.row_key(),
+            format_env(record.ref.Environment),
+            record.fingerprint,
+            record.outcome)
+        sink.write(record.to_result())
+    try:
+        records = iter_records(workers, where=wanted)
+        return process_records(records, deactivate_serials, note)
+    finally:
+        close_journal()
+        sink.close()
+        results.save()
+
+
+def plan_file_path():
+    folder = os.path.split(result_file_path('user_adds'))[0]
+    return os.path.join(folder, 'user_add_plan.json')
+
+
+def plan_records(records, path=None, deactivate_serials=False):
+    """Matches and validates Records without writing, saving the plan.
+
+    Prints the estimated API calls per sobject; apply_plan_file sends it.
+    """
+    path = plan_file_path() if path is None else path
+    plan = build_plan(records, deactivate_serials)
+    flush_force_defs()
+    save_plan(plan, path)
+    print(plan.summary())
+    return plan
+
+
+def apply_plan_file(path=None):
+    """Sends a saved plan; steps already done are not sent again"""
+    path = plan_file_path() if path is None else path
+    plan = load_plan(path).apply(path)
+    print(plan.summary())
+    write_metrics()
+    return plan
+
+
+def metrics_file_path(extension):
+    base = os.path.splitext(result_file_path('user_adds'))[0]
+    return '%s.metrics%s' % (base, extension)
+
+
+def write_metrics():
+    """Saves REST call counts and stage timings beside the results"""
+    path = metrics.write_report(
+        metrics_file_path('.json'), metrics_file_path('.prom'))
+    print('Run metrics written to %s' % path)
+    return path
 
 
 def report_file_path(report_name):
@@ -32,28 +207,21 @@ def read_user_add_report():
         return json.load(f)
 
 
+def iter_user_add_report():
+    """Streams the raw rows of the user add report"""
+    file_path = report_file_path('user_adds')
+    with open(file_path, 'r') as f:
+        for rec in iter_items(f, 'results'):
+            yield rec
+
+
 def import_json_dict(jsonfile):
     """Imports json file as dict and decodes RAW"""
-    sid = None
-    with open(jsonfile, 'r') as f:
-        sid = json.load(f)
-    rslts = []
-    for rec in [x for x in sid.get('results', [])]:
-        rl = [decode_input(**v) for k, v in rec.items()]
-        rslts.append({x[0]: x[1] for x in rl if x is not None})
-    return rslts
-
-
-def decode_input(**kwargs):
-    """decodes all RAW inputs to text"""
-    name = kwargs.get('name', None)
-    dtype = kwargs.get('type', 'VARCHAR2')
-    value = kwargs.get('value', None)
-    if name is None:
-        return None
-    if dtype == 'RAW':
-        if value is not None:
-            return (name, bytes.fromhex(value).decode('utf8'))
-        else:
-            return (name, '')
-    return (name, value)
+    return [x for x in iter_json_dict(jsonfile)]
+
+
+report_store = ReportStore(
+    report_file_path,
+    import_json_dict,
+    streamer=iter_json_dict,
+    modes={k: v.mode for k, v in config.reports.items()})
@@ -0,0 +1,134 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from .connections import connection_env
+from .paths import write_atomic
+
+
+PREFIX = 'useradddata_'
+BUCKETS = [
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+    60.0]
+
+
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+
+
+def label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, by=1, **labels):
+    """Adds to a counter, one series per set of labels"""
+    key = (name, label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + by
+
+
+def observe(name, value, **labels):
+    """Adds a value, usually seconds, to a histogram"""
+    key = (name, label_key(labels))
+    with _lock:
+        series = _histograms.get(key, None)
+        if series is None:
+            series = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+            _histograms[key] = series
+        for idx, bound in enumerate(BUCKETS):
+            if value <= bound:
+                series['buckets'][idx] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observes the seconds the block took, raised or not"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def rest_call(conn, kind, sobject, call):
+    """Counts and times one REST call made through conn"""
+    env = connection_env(conn) or 'unknown'
+    inc('rest_calls_total', kind=kind, sobject=sobject, env=env)
+    with timer('rest_call_seconds', kind=kind, sobject=sobject, env=env):
+        return call()
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def to_dict():
+    with _lock:
+        counters = [
+            {'name': k[0], 'labels': dict(k[1]), 'value': v}
+            for k, v in sorted(_counters.items())]
+        histograms = [
+            {'name': k[0], 'labels': dict(k[1]), 'count': v['count'],
+             'sum': v['sum'], 'buckets': dict(zip(BUCKETS, v['buckets']))}
+            for k, v in sorted(_histograms.items())]
+    return {'counters': counters, 'histograms': histograms}
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def format_labels(labels, extra=None):
+    pairs = [x for x in labels]
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, escape(v)) for k, v in pairs])
+
+
+def to_prometheus():
+    """Everything in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(
+            (k, dict(v, buckets=list(v['buckets'])))
+            for k, v in _histograms.items())
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append('# TYPE %s%s counter' % (PREFIX, name))
+            typed.add(name)
+        lines.append('%s%s%s %s' % (
+            PREFIX, name, format_labels(labels), value))
+    for (name, labels), series in histograms:
+        if name not in typed:
+            lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+            typed.add(name)
+        for bound, count in zip(BUCKETS, series['buckets']):
+            lines.append('%s%s_bucket%s %d' % (
+                PREFIX, name, format_labels(labels, ('le', str(bound))),
+                count))
+        lines.append('%s%s_bucket%s %d' % (
+            PREFIX, name, format_labels(labels, ('le', '+Inf')),
+            series['count']))
+        lines.append('%s%s_sum%s %f' % (
+            PREFIX, name, format_labels(labels), series['sum']))
+        lines.append('%s%s_count%s %d' % (
+            PREFIX, name, format_labels(labels), series['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(json_path, prom_path=None):
+    """Writes the run's metrics as JSON and, if given, a Prometheus file"""
+    write_atomic(json_path, json.dumps(to_dict(), indent=3))
+    if prom_path is not None:
+        write_atomic(prom_path, to_prometheus())
+    return json_path
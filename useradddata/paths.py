@@ -0,0 +1,18 @@
+import os
+
+
+def data_folder():
+    """Folder holding config.json, decisions.json and validation_rules.
+
+    This is the package folder unless USERADDDATA_HOME names another.
+    """
+    return os.environ.get('USERADDDATA_HOME', os.path.split(__file__)[0])
+
+
+def write_atomic(path, text):
+    """Writes text through a temp file so readers never see half of it"""
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+    return path
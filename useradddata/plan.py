@@ -0,0 +1,229 @@
+import json
+from datetime import datetime
+from . import querycache
+from .connections import format_env, get_connection
+from .decisions import DecisionDeferred
+from .paths import write_atomic
+from .spaces.actions import InsertAction, UpdateAction
+from .spaces.bulk import COLLECTION_SIZE, insert_records, update_records
+from .spaces.serials import reconcile_serials
+
+
+USER_LINKS = ['AssigneeId', 'SVMXC__Salesforce_User__c',
+              'SVMXC__Service_Engineer__c', 'GEHC_LS_Tech_Owner_Reference__c']
+
+
+class Plan():
+    """Actions and validated payloads for a batch of Records.
+
+    Planning runs matching and validation but writes nothing. Each step
+    names the steps whose sfids fill its linked fields, so apply can send
+    the steps in dependency order, one collection call per sobject.
+    """
+    def __init__(self, **kwargs):
+        self.created = kwargs.get('created', datetime.now().isoformat())
+        self.steps = kwargs.get('steps', [])
+        self.deferred = kwargs.get('deferred', [])
+
+    def to_dict(self):
+        return {
+            'created': self.created,
+            'estimate': self.estimate(),
+            'deferred': self.deferred,
+            'steps': self.steps}
+
+    def add_step(self, record, space, links=None, check=None):
+        """Plans space's action; links maps fields to provider step ids"""
+        links = {} if links is None else links
+        space.valid_fields.update(links.keys())
+        if space.action is None:
+            space.action = space.determine_action()
+        if check is None:
+            space.validate()
+        else:
+            space.valid = check()
+        step = {
+            'id': '%s:%d' % (record.row_key(), len(self.steps)),
+            'row': record.row_key(),
+            'env': format_env(record.ref.Environment),
+            'sobject': space.sobject,
+            'name': space.get_name(),
+            'action': 'skip',
+            'sfid': space.sfid,
+            'payload': None,
+            'links': links,
+            'status': 'done',
+            'error': None}
+        if not space.valid:
+            step['status'] = 'invalid'
+        elif isinstance(space.action, (InsertAction, UpdateAction)):
+            step['action'] = space.action.name
+            step['status'] = 'planned'
+            step['payload'] = {
+                k: v for k, v in space.action.payload().items()
+                if k not in links}
+            if isinstance(space.action, UpdateAction):
+                step['sfid'] = space.action.sfid
+        self.steps.append(step)
+        return step['id']
+
+    def add_record(self, record, deactivate=False):
+        user = self.add_step(record, record.user)
+        record.ref.add_field('SF_User_Id', record.user.sfid)
+        for space in record.attached_spaces():
+            space.set_user_fields()
+        for set_ in record.permission_sets:
+            self.add_permission_set(record, set_, user)
+        site = record.select_site()
+        if site is None:
+            return
+        site_id = self.add_step(record, site, self.user_links(site, user))
+        record.load_site_stock()
+        record.technician.set_locn_fields()
+        links = self.user_links(record.technician, user)
+        links['SVMXC__Inventory_Location__c'] = site_id
+        self.add_step(record, record.technician, links)
+        stock_ids = {}
+        for stock in record.stock:
+            stock.set_locn_fields()
+            stock_ids[id(stock)] = self.add_step(
+                record, stock, {'SVMXC__Location__c': site_id})
+        for stock, ser in reconcile_serials(record, deactivate).items():
+            self.add_step(
+                record,
+                ser,
+                {'SVMXC__Product_Stock__c': stock_ids[id(stock)]})
+
+    def add_permission_set(self, record, set_, user):
+        if set_.action is None and record.user.sfid is None:
+            set_.action = InsertAction(set_)
+        return self.add_step(
+            record,
+            set_,
+            {'AssigneeId': user},
+            set_.validate_permissionset)
+
+    def user_links(self, space, user):
+        return {x: user for x in USER_LINKS if x in space.fields}
+
+    def estimate(self):
+        """REST calls per sobject, one-by-one against collections"""
+        counts = {}
+        for step in [x for x in self.steps if x['status'] == 'planned']:
+            key = (step['env'], step['sobject'], step['action'])
+            counts[key] = counts.get(key, 0) + 1
+        estimate = {}
+        for key, count in counts.items():
+            sobject = estimate.setdefault(key[1], {
+                'insert': 0, 'update': 0, 'calls': 0, 'single_calls': 0})
+            sobject[key[2]] += count
+            sobject['single_calls'] += count
+            sobject['calls'] += -(-count // COLLECTION_SIZE)
+        return estimate
+
+    def summary(self):
+        lines = []
+        for sobject, counts in sorted(self.estimate().items()):
+            lines.append('%s: %d inserts, %d updates, %d calls (%d singly)' % (
+                sobject,
+                counts['insert'],
+                counts['update'],
+                counts['calls'],
+                counts['single_calls']))
+        invalid = len([x for x in self.steps if x['status'] == 'invalid'])
+        lines.append('%d invalid steps, %d Records deferred' % (
+            invalid, len(self.deferred)))
+        return '\n'.join(lines)
+
+    def ready_steps(self):
+        by_id = {x['id']: x for x in self.steps}
+        ready = []
+        for step in [x for x in self.steps if x['status'] == 'planned']:
+            linked = [by_id[x] for x in step['links'].values()]
+            if any(x['status'] in ['failed', 'invalid', 'blocked']
+                   for x in linked):
+                step['status'] = 'blocked'
+                step['error'] = 'A step it depends on did not succeed.'
+                continue
+            if any(x['status'] == 'done' and x['sfid'] is None
+                   for x in linked):
+                step['status'] = 'blocked'
+                step['error'] = 'A step it depends on is done without an Id.'
+                continue
+            if all(x['sfid'] is not None for x in linked):
+                ready.append(step)
+        return ready
+
+    def apply(self, path=None):
+        """Sends the planned steps, saving progress after every round.
+
+        Steps that can never get the Ids they link to end up blocked.
+        """
+        by_id = {x['id']: x for x in self.steps}
+        ready = self.ready_steps()
+        while len(ready) > 0:
+            groups = {}
+            for step in ready:
+                key = (step['env'], step['sobject'], step['action'])
+                groups.setdefault(key, []).append(step)
+            for key, steps in groups.items():
+                self.apply_group(key, steps, by_id)
+            if path is not None:
+                save_plan(self, path)
+            ready = self.ready_steps()
+        for step in [x for x in self.steps if x['status'] == 'planned']:
+            step['status'] = 'blocked'
+            step['error'] = 'A step it depends on never ran.'
+        if path is not None:
+            save_plan(self, path)
+        return self
+
+    def apply_group(self, key, steps, by_id):
+        env, sobject, action = key
+        conn = get_connection(env)
+        payloads = []
+        for step in steps:
+            payload = {
+                k: by_id[v]['sfid'] for k, v in step['links'].items()}
+            payloads.append({**step['payload'], **payload})
+        if action == 'insert':
+            results = insert_records(conn, sobject, payloads)
+        else:
+            results = update_records(
+                conn,
+                sobject,
+                [{**x, 'Id': y['sfid']} for x, y in zip(payloads, steps)])
+        written = []
+        for step, payload, result in zip(steps, payloads, results):
+            if result.get('success', False):
+                step['status'] = 'done'
+                step['sfid'] = result.get('id', None) or step['sfid']
+                written.append({**payload, 'Id': step['sfid']})
+            else:
+                step['status'] = 'failed'
+                step['error'] = '; '.join([
+                    x.get('message', str(x))
+                    for x in result.get('errors', [])])
+        if len(written) > 0:
+            querycache.invalidate(conn, sobject, written)
+
+
+def build_plan(records, deactivate_serials=False):
+    plan = Plan()
+    for record in records:
+        try:
+            plan.add_record(record, deactivate_serials)
+        except DecisionDeferred as e:
+            print('Set aside %s: %s' % (record.user.get_name(), str(e)))
+            plan.deferred.append(record.row_key())
+    return plan
+
+
+def save_plan(plan, path):
+    return write_atomic(
+        path, json.dumps(plan.to_dict(), indent=3, default=str))
+
+
+def load_plan(path):
+    with open(path, 'r') as f:
+        return Plan(**json.load(f))
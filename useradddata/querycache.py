@@ -0,0 +1,176 @@
+import time
+import threading
+import force as sf
+from urllib.parse import quote_plus
+from . import metrics
+from . import ratelimit
+from .connections import connection_env
+
+
+QUERY_URL = '%s/services/data/v42.0/query?q=%s'
+DEFAULT_TTL = 600
+NEGATIVE_TTL = 60
+TTLS = {
+    'BusinessHours': 3600,
+    'PermissionSet': 3600,
+    'Profile': 3600,
+    'UserRole': 3600}
+
+
+_entries = {}
+_counts = {
+    'hits': 0,
+    'negative_hits': 0,
+    'misses': 0,
+    'expired': 0,
+    'invalidations': 0}
+_listeners = []
+_lock = threading.Lock()
+
+
+def env_key(conn):
+    env = connection_env(conn)
+    return id(conn) if env is None else env
+
+
+def ttl(sobject, rows):
+    """Seconds rows of sobject stay cached; empty results expire sooner"""
+    if len(rows) == 0:
+        return min(NEGATIVE_TTL, TTLS.get(sobject, DEFAULT_TTL))
+    return TTLS.get(sobject, DEFAULT_TTL)
+
+
+def expires(sobject, rows):
+    return time.monotonic() + ttl(sobject, rows)
+
+
+def is_live(expiry):
+    return expiry > time.monotonic()
+
+
+def count(name, by=1):
+    with _lock:
+        _counts[name] = _counts.get(name, 0) + by
+    metrics.inc('query_cache_total', by, result=name)
+
+
+def stats():
+    with _lock:
+        return dict(_counts)
+
+
+def as_tuple(given):
+    if given is None:
+        return ()
+    if isinstance(given, str):
+        return (given,)
+    return tuple(given)
+
+
+def cached(key, sobject, query):
+    """Rows for key, running query when they are missing or stale"""
+    with _lock:
+        entry = _entries.get(key, None)
+    if entry is not None:
+        if is_live(entry[0]):
+            count('hits' if len(entry[1]) > 0 else 'negative_hits')
+            return [dict(x) for x in entry[1]]
+        count('expired')
+    count('misses')
+    rows = query()
+    with _lock:
+        _entries[key] = (expires(sobject, rows), rows)
+    return [dict(x) for x in rows]
+
+
+def soql(conn, fields, sobject, filters=None):
+    """sf.SOQL(...).get_results(), remembered per environment"""
+    key = (
+        env_key(conn), 'soql', sobject, as_tuple(fields), as_tuple(filters))
+    return cached(key, sobject, lambda: ratelimit.limited(
+        conn, 'query', sobject, lambda: sf.SOQL(
+            conn,
+            fields=fields,
+            sobject=sobject,
+            filters=filters).get_results()))
+
+
+def sosl(conn, terms, sobject, join_terms_on=None):
+    """sf.SOSL(...).get_results(), remembered per environment"""
+    key = (
+        env_key(conn), 'sosl', sobject, as_tuple(terms), join_terms_on)
+    kwargs = {'terms': terms, 'sobject': sobject}
+    if join_terms_on is not None:
+        kwargs['join_terms_on'] = join_terms_on
+    return cached(key, sobject, lambda: ratelimit.limited(
+        conn, 'search', sobject,
+        lambda: sf.SOSL(conn, **kwargs).get_results()))
+
+
+def query_all(conn, statement, sobject=None):
+    """Every row of a SOQL statement over REST, child rows included.
+
+    Unlike soql this is not cached, and it takes relationship subqueries.
+    sobject only labels the calls in metrics.
+    """
+    instance_url = conn.auth['instance_url']
+    url = QUERY_URL % (instance_url, quote_plus(statement))
+    rows = []
+    while url is not None:
+        response = ratelimit.limited(
+            conn, 'query', sobject, lambda: conn.req_get(url))
+        rows.extend(response.get('records', []))
+        next_url = response.get('nextRecordsUrl', None)
+        url = None if next_url is None else instance_url + next_url
+    for row in rows:
+        for key, value in row.items():
+            if isinstance(value, dict) and 'records' in value:
+                row[key] = child_records(conn, value, sobject)
+    return rows
+
+
+def child_records(conn, children, sobject=None):
+    rows = [x for x in children.get('records', [])]
+    next_url = children.get('nextRecordsUrl', None)
+    while next_url is not None:
+        url = conn.auth['instance_url'] + next_url
+        response = ratelimit.limited(
+            conn, 'query', sobject, lambda: conn.req_get(url))
+        rows.extend(response.get('records', []))
+        next_url = response.get('nextRecordsUrl', None)
+    return rows
+
+
+def on_invalidate(listener):
+    """Calls listener(env_key, sobject, rows) on every invalidation"""
+    with _lock:
+        _listeners.append(listener)
+    return listener
+
+
+def invalidate(conn=None, sobject=None, rows=None):
+    """Forgets cached results after a write.
+
+    Without conn every environment is cleared, without sobject every
+    sobject. rows, the records written with their Id, are passed on to the
+    listeners so they can forget only those.
+    """
+    env = None if conn is None else env_key(conn)
+    with _lock:
+        stale = [
+            k for k in _entries.keys()
+            if (env is None or k[0] == env) and
+            (sobject is None or k[2] == sobject)]
+        for key in stale:
+            del _entries[key]
+        _counts['invalidations'] += 1
+        listeners = [x for x in _listeners]
+    for listener in listeners:
+        listener(env, sobject, rows)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+        for key in _counts.keys():
+            _counts[key] = 0
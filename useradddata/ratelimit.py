@@ -0,0 +1,253 @@
+import re
+import time
+import threading
+from . import metrics
+from .connections import connection_env, reauthenticate
+
+
+LIMITS_URL = '%s/services/data/v42.0/limits/'
+LIMIT_INFO = re.compile(r'api-usage=(\d+)/(\d+)')
+LIMIT_ERROR = 'REQUEST_LIMIT_EXCEEDED'
+SESSION_ERROR = 'INVALID_SESSION_ID'
+RETRY_STATUS = (429, 503)
+DEFAULT_LIMITS = {
+    'reserve': 0.1,
+    'rate': 100.0,
+    'burst': 50,
+    'max_in_flight': 16,
+    'target_latency': 0.5,
+    'pause': 30.0,
+    'retries': 3,
+    'check_every': 200}
+
+
+_settings = dict(DEFAULT_LIMITS)
+_limiters = {}
+_lock = threading.Lock()
+
+
+class ApiLimitReached(RuntimeError):
+    def __init__(self, env, used, allowed):
+        self.env = env
+        self.used = used
+        self.allowed = allowed
+        super(ApiLimitReached, self).__init__(
+            'Stopped at %d of %d daily API requests in %s; the rest is '
+            'kept in reserve.' % (used, allowed, env))
+
+
+def configure(**kwargs):
+    """Changes the limits later limiters start with.
+
+    reserve is the share of the org's daily allocation left for other
+    integrations; see DEFAULT_LIMITS for the rest.
+    """
+    unknown = [x for x in kwargs.keys() if x not in DEFAULT_LIMITS]
+    if len(unknown) > 0:
+        raise RuntimeError('Unknown API limit settings: %s' % (
+            ', '.join(unknown)))
+    with _lock:
+        _settings.update(kwargs)
+        _limiters.clear()
+    return dict(_settings)
+
+
+def get_limiter(conn):
+    env = connection_env(conn) or 'unknown'
+    with _lock:
+        limiter = _limiters.get(env, None)
+        if limiter is None:
+            limiter = Limiter(env, **_settings)
+            _limiters[env] = limiter
+        return limiter
+
+
+def limited(conn, kind, sobject, call):
+    """Makes one REST call through conn's limiter, counted in metrics"""
+    return get_limiter(conn).run(
+        conn, lambda: metrics.rest_call(conn, kind, sobject, call))
+
+
+def pushback(result):
+    """Why the org turned a call away, or None if it did not"""
+    status = getattr(result, 'status_code', None)
+    if status in RETRY_STATUS:
+        return str(status)
+    if isinstance(result, list) and any(
+            isinstance(x, dict) and x.get('errorCode', None) == LIMIT_ERROR
+            for x in result):
+        return LIMIT_ERROR
+    return None
+
+
+def session_expired(result):
+    """Whether the org refused a call because its session expired"""
+    if isinstance(result, Exception):
+        return SESSION_ERROR in str(result)
+    if getattr(result, 'status_code', None) == 401:
+        return True
+    return isinstance(result, list) and any(
+        isinstance(x, dict) and x.get('errorCode', None) == SESSION_ERROR
+        for x in result)
+
+
+def limit_info(result):
+    """(used, allowed) from a response's Sforce-Limit-Info header"""
+    headers = getattr(result, 'headers', None)
+    if headers is None:
+        return None
+    found = LIMIT_INFO.search(headers.get('Sforce-Limit-Info', '') or '')
+    if found is None:
+        return None
+    return (int(found.group(1)), int(found.group(2)))
+
+
+class Limiter():
+    """Paces the REST calls made to one org.
+
+    Calls take a token from a bucket refilled at rate per second, and at
+    most window of them are in flight. The window grows by one for each
+    window's worth of calls answered within target_latency (or twice the
+    fastest answer seen, if slower), shrinks by a quarter when answers are
+    slower, and halves when the org answers 429, 503 or
+    REQUEST_LIMIT_EXCEEDED; those calls are retried after a pause that
+    doubles each time. Daily usage comes from Sforce-Limit-Info when the
+    connection returns headers and from /limits every check_every calls.
+    Calls stop with ApiLimitReached once only the reserve is left. A call
+    refused for an expired session is retried once after signing in again.
+    """
+    def __init__(self, env, reserve=0.1, rate=100.0, burst=50,
+                 max_in_flight=16, target_latency=0.5, pause=30.0,
+                 retries=3, check_every=200):
+        self.env = env
+        self.reserve = reserve
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_in_flight = max_in_flight
+        self.target_latency = target_latency
+        self.pause = pause
+        self.retries = retries
+        self.check_every = check_every
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.window = 1.0
+        self.in_flight = 0
+        self.fastest = None
+        self.last_cut = 0.0
+        self.resume_at = 0.0
+        self.calls = 0
+        self.used = None
+        self.allowed = None
+        self.cond = threading.Condition()
+
+    def run(self, conn, call):
+        attempt = 0
+        signed_in = False
+        while True:
+            self.check_usage(conn)
+            self.acquire()
+            auth = getattr(conn, 'auth', None)
+            start = time.monotonic()
+            try:
+                result = call()
+                reason = pushback(result)
+            except Exception as e:
+                reason = LIMIT_ERROR if LIMIT_ERROR in str(e) else None
+                self.release(time.monotonic() - start, reason is not None)
+                if not signed_in and session_expired(e):
+                    signed_in = True
+                    if reauthenticate(conn, auth):
+                        continue
+                if reason is None or attempt >= self.retries:
+                    raise
+            else:
+                self.release(time.monotonic() - start, reason is not None)
+                if not signed_in and session_expired(result):
+                    signed_in = True
+                    if reauthenticate(conn, auth):
+                        continue
+                usage = limit_info(result)
+                if usage is not None:
+                    self.set_usage(*usage)
+                if reason is None or attempt >= self.retries:
+                    return result
+            metrics.inc('api_pushback_total', env=self.env, reason=reason)
+            self.wait(self.pause * 2 ** attempt)
+            attempt += 1
+
+    def acquire(self):
+        with self.cond:
+            waited = time.monotonic()
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                delay = max(
+                    self.resume_at - now,
+                    (1.0 - self.tokens) / self.rate)
+                if self.in_flight < int(self.window) and delay <= 0:
+                    break
+                self.cond.wait(delay if delay > 0 else None)
+            self.tokens -= 1.0
+            self.in_flight += 1
+            self.calls += 1
+            waited = time.monotonic() - waited
+        if waited > 0.001:
+            metrics.observe('api_wait_seconds', waited, env=self.env)
+
+    def release(self, latency, pushed_back):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if self.fastest is None or latency < self.fastest:
+                self.fastest = latency
+            target = max(self.target_latency, self.fastest * 2)
+            if pushed_back:
+                self.window = max(1.0, self.window / 2)
+                self.last_cut = now
+            elif latency > target:
+                if now - self.last_cut > target:
+                    self.window = max(1.0, self.window * 0.75)
+                    self.last_cut = now
+            else:
+                self.window = min(
+                    float(self.max_in_flight),
+                    self.window + 1.0 / int(self.window))
+            self.cond.notify_all()
+
+    def wait(self, seconds):
+        """Holds every call to this org back for seconds"""
+        print('%s pushed back; pausing %.0fs.' % (self.env, seconds))
+        with self.cond:
+            self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+        time.sleep(seconds)
+
+    def set_usage(self, used, allowed):
+        with self.cond:
+            self.used = used
+            self.allowed = allowed
+
+    def check_usage(self, conn):
+        if self.check_every and self.calls % self.check_every == 0:
+            self.read_limits(conn)
+        with self.cond:
+            if self.allowed is None:
+                return
+            if self.used >= self.allowed * (1 - self.reserve):
+                raise ApiLimitReached(self.env, self.used, self.allowed)
+            self.used += 1
+
+    def read_limits(self, conn):
+        """Reads daily usage from /limits, which is not itself counted"""
+        auth = getattr(conn, 'auth', None) or {}
+        if 'instance_url' not in auth:
+            return
+        try:
+            limits = conn.req_get(LIMITS_URL % auth['instance_url'])
+            daily = limits['DailyApiRequests']
+        except Exception as e:
+            print('Could not read API limits for %s: %s' % (self.env, e))
+            return
+        self.set_usage(daily['Max'] - daily['Remaining'], daily['Max'])
@@ -1,15 +1,47 @@
-import force as sf
+import time
+import threading
+from . import metrics
+from .connections import format_env, get_connection
+from .decisions import get_policy
+from .journal import get_journal
+from .results import row_fingerprint
+from .scheduler import run_record
 from .spaces import (
     RecordSpace,
+    SiteStock,
     UserSpace,
     PermissionSetSpace,
-    LocationSpace,
     TechSpace,
     add_stock,
-    matching_locations)
+    matching_locations,
+    reconcile_serials,
+    take_actions)
+from .spaces.actions import DoneAction
+
+
+print_lock = threading.Lock()
+
+
+def parse_row(given):
+    """Field values of a user add report row, by field name"""
+    return {v['name']: v['value'] for k, v in given.items()}
+
+
+def report_row_key(values):
+    """The request id of a user add row, or None if it has none"""
+    for field in ['RECORD_ID', 'RequestId']:
+        value = values.get(field, None)
+        if value not in ['', None]:
+            return str(value)
+    return None
 
 
 def inspect_record(record):
+    with print_lock:
+        print_record(record)
+
+
+def print_record(record):
     print('-' * 40)
     print('User Add for %s %s (%s):' % (
         record.ref.FirstName,
@@ -28,20 +60,50 @@ def inspect_record(record):
     print('-' * 40)
 
 
+class lazy_attribute():
+    """Builds an attribute with the decorated method on first access"""
+    def __init__(self, builder):
+        self.builder = builder
+        self.name = builder.__name__
+        self.__doc__ = builder.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = self.builder(obj)
+        obj.__dict__[self.name] = value
+        return value
+
+
 class Record():
+    SPACE_ROLES = ['user', 'permission_sets', 'sites', 'technician', 'stock']
+
     def __init__(self, given):
-        parsed_raw = {v['name']: v['value'] for k, v in given.items()}
+        start = time.perf_counter()
+        parsed_raw = parse_row(given)
+        self.fingerprint = row_fingerprint(parsed_raw)
+        self.outcome = None
+        self.timings = {}
         self.ref = RecordSpace(self, None, **parsed_raw)
-        self.user = UserSpace(self)
-        self.permission_sets = self.set_permissionsets()
-        self.sites = matching_locations(self)
-        self.technician = None
-        self.stock = []
         self.conn = self.make_connection()
-        if len(self.sites) > 0:
-            self.technician = TechSpace(self)
-            add_stock(self)
-        inspect_record(self)
+        with metrics.timer('record_stage_seconds', stage='spaces'):
+            self.user = UserSpace(self)
+            self.permission_sets = self.set_permissionsets()
+            self.sites = matching_locations(self)
+            self.technician = None
+            self.stock = []
+            self.site_stock = None
+            if len(self.sites) > 0:
+                self.technician = TechSpace(self)
+                add_stock(self)
+        self.restore_journaled()
+        with metrics.timer('record_stage_seconds', stage='want_matches'):
+            for space in self.attached_spaces():
+                if space.action is None:
+                    space.want_matches()
+        with metrics.timer('record_stage_seconds', stage='inspect'):
+            inspect_record(self)
+        self.timings['build'] = time.perf_counter() - start
 
     def set_permissionsets(self):
         psids = [
@@ -49,15 +111,18 @@ class Record():
         return [PermissionSetSpace(self, x) for x in psids]
 
     def make_connection(self):
-        env = getattr(self.ref, 'Environment').lower()
-        env = ''.join(env.split(' ')).strip()
-        return sf.Connection(env)
+        return get_connection(getattr(self.ref, 'Environment'))
+
+    def role_spaces(self, role):
+        spaces = getattr(self, role)
+        if spaces is None:
+            return []
+        return spaces if isinstance(spaces, list) else [spaces]
 
     def attached_spaces(self):
-        attrs = [getattr(self, x) for x in dir(self)]
-        spaces = [x for x in attrs if isinstance(x, RecordSpace)]
-        for list_ in [x for x in attrs if isinstance(x, list)]:
-            spaces.extend([x for x in list_ if isinstance(x, RecordSpace)])
+        spaces = [self.ref]
+        for role in self.SPACE_ROLES:
+            spaces.extend(self.role_spaces(role))
         return spaces
 
     def to_dict(self):
@@ -72,39 +137,173 @@ class Record():
             rtn['technician'] = self.technician.to_dict()
         return rtn
 
-    def process_user(self):
-        self.user.take_action()
-        self.ref.SF_User_Id = self.user.sfid
-        for space in self.attached_spaces():
-            space.set_user_fields()
-        for set_ in self.permission_sets:
-            set_.take_action()
+    def to_result(self):
+        """What happened to this Record, one entry per space"""
+        spaces = []
+        for role in self.SPACE_ROLES:
+            for space in self.role_spaces(role):
+                action = space.action
+                spaces.append({
+                    'role': role,
+                    'sobject': space.sobject,
+                    'name': space.get_name(),
+                    'action': getattr(action, 'previous', None) or getattr(
+                        action, 'name', None),
+                    'success': getattr(action, 'success', False),
+                    'sfid': space.sfid,
+                    'problems': space.problems})
+        return {
+            'row': self.row_key(),
+            'env': format_env(self.ref.Environment),
+            'fingerprint': self.fingerprint,
+            'outcome': self.outcome,
+            'timings': {k: round(v, 3) for k, v in self.timings.items()},
+            'spaces': spaces}
+
+    def row_key(self):
+        """Identifies the user add report row this Record came from"""
+        key = report_row_key(self.ref.values)
+        return self.user.get_name() if key is None else key
+
+    def restore_journaled(self):
+        """Marks spaces the open journal holds as done, keeping their sfid.
+
+        A journaled site becomes the chosen one. Returns the spaces marked.
+        """
+        journal = get_journal()
+        if journal is None:
+            return []
+        restored = []
+        for space in self.attached_spaces()[1:]:
+            entry = journal.completed(self, space)
+            if entry is None:
+                continue
+            space.sfid = entry['sfid']
+            space.action = DoneAction(space, entry['done'], True)
+            restored.append(space)
+        sites = [x for x in self.sites if x in restored]
+        if len(sites) > 0:
+            self.sites = sites[:1]
+        return restored
+
+    def finished(self, succeeded):
+        """Whether every space and the serials succeeded"""
+        if len(self.stock) > 0 and 'serials' not in succeeded:
+            return False
+        return all(
+            isinstance(x.action, DoneAction) and x.action.success
+            for x in self.attached_spaces()[1:])
 
-    def process_sites(self):
+    def select_site(self):
         if len(self.sites) == 0:
-            return
+            return None
         selection = 0
         if len(self.sites) > 1:
-            print("Choose a site:")
-            for idx, site in enumerate(self.sites):
-                print("%d.\t%s\t%s\t%s\t%s" % (
-                    idx,
-                    site.Oracle_Ship_to_Number__c,
-                    site.Oracle_Location_ID__c,
-                    site.Operating_Unit__c,
-                    site.Source_Organization__c))
-            selection = int(input())
-        site = self.sites[selection]
-        self.sites = [site]
-        site.take_action()
-        self.technician.set_locn_fields()
-        for stock in self.stock:
-            stock.set_locn_fields()
-        self.technician.take_action()
-        self.process_stock()
+            selection = get_policy().choose(
+                'choose_site',
+                self.sites,
+                self.ref.to_dict(),
+                self.prompt_site)
+        if selection is None:
+            print('No site chosen for %s.' % self.user.get_name())
+            self.sites = []
+            return None
+        self.sites = [self.sites[selection]]
+        return self.sites[0]
+
+    def process(self, max_workers=4, deactivate_serials=False):
+        """Takes every space's action once the spaces it requires are done.
+
+        Sets outcome to finished or incomplete and returns the roles that
+        succeeded.
+        """
+        journal = get_journal()
+        if journal is not None and journal.row_finished(self):
+            print('Skipped %s: finished in an earlier run.' % (
+                self.user.get_name()))
+            self.outcome = 'finished'
+            return set()
+        start = time.perf_counter()
+        self.select_site()
+        succeeded = run_record(self, max_workers, deactivate_serials)
+        self.timings['process'] = time.perf_counter() - start
+        finished = self.finished(succeeded)
+        self.outcome = 'finished' if finished else 'incomplete'
+        if journal is not None:
+            journal.note_row(self, finished, succeeded)
+        return succeeded
 
-    def process_stock(self):
-        if len(self.stock) == 0:
-            return
+    def finish_role(self, role):
+        if role == 'user':
+            self.ref.add_field('SF_User_Id', self.user.sfid)
+        elif role == 'sites':
+            self.load_site_stock()
+
+    def load_site_stock(self):
+        """Matches stock to what the chosen site already holds"""
+        if len(self.sites) == 0 or self.sites[0].sfid is None:
+            return None
+        self.site_stock = SiteStock(self.conn, self.sites[0].sfid).load()
         for stock in self.stock:
-            self.technician.take_action()
+            stock.match_site_stock(self.site_stock)
+        return self.site_stock
+
+    def prompt_site(self):
+        print("Choose a site:")
+        for idx, site in enumerate(self.sites):
+            print("%d.\t%s\t%s\t%s\t%s" % (
+                idx,
+                site.Oracle_Ship_to_Number__c,
+                site.Oracle_Location_ID__c,
+                site.Operating_Unit__c,
+                site.Source_Organization__c))
+        return int(input())
+
+    def sync_serials(self, deactivate=False):
+        diff = reconcile_serials(self, deactivate)
+        print('%s: %s.' % (self.technician.get_name(), diff.summary()))
+        spaces = diff.spaces()
+        return len(take_actions(spaces)) == len(spaces)
+
+
+class LazyRecord(Record):
+    """Record whose connection and spaces are built on first access.
+
+    Offline, no connection is opened and no lookups are announced, so a
+    report can be reviewed with inspect_record or to_dict without
+    Salesforce.
+    """
+    def __init__(self, given, offline=False):
+        parsed_raw = parse_row(given)
+        self.fingerprint = row_fingerprint(parsed_raw)
+        self.outcome = None
+        self.timings = {}
+        self.offline = offline
+        self.ref = RecordSpace(self, None, **parsed_raw)
+        self.site_stock = None
+
+    @lazy_attribute
+    def conn(self):
+        return None if self.offline else self.make_connection()
+
+    @lazy_attribute
+    def user(self):
+        return UserSpace(self)
+
+    @lazy_attribute
+    def permission_sets(self):
+        return self.set_permissionsets()
+
+    @lazy_attribute
+    def sites(self):
+        return matching_locations(self)
+
+    @lazy_attribute
+    def technician(self):
+        return TechSpace(self) if len(self.sites) > 0 else None
+
+    @lazy_attribute
+    def stock(self):
+        if len(self.sites) > 0:
+            add_stock(self)
+        return self.__dict__.get('stock', [])
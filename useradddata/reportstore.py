@@ -0,0 +1,168 @@
+import threading
+from .snapshot import (
+    ALL_FIELDS, SnapshotReport, build_snapshots, file_stamp, is_fresh)
+
+
+# matching_locations falls back to every locations column
+REPORT_INDEXES = {
+    'locations': [
+        'Location_Number__c', 'Oracle_Ship_to_Number__c', ALL_FIELDS],
+    'prod_stock': ['Subinventory'],
+    'ser_stock': ['Key']}
+
+
+class Report():
+    """Decoded rows of one report file with hash indexes by field"""
+    def __init__(self, name, file_path, loader, index_fields=None):
+        self.name = name
+        self.file_path = file_path
+        self.stamp = file_stamp(file_path)
+        self.rows = loader(file_path)
+        self.indexes = {}
+        for field in [] if index_fields is None else index_fields:
+            if field != ALL_FIELDS:
+                self.index(field)
+
+    def is_stale(self, file_path):
+        if file_path != self.file_path:
+            return True
+        try:
+            return file_stamp(file_path) != self.stamp
+        except OSError:
+            return True
+
+    def index(self, field):
+        if field not in self.indexes:
+            built = {}
+            for row in self.rows:
+                if field in row:
+                    built.setdefault(row[field], []).append(row)
+            self.indexes[field] = built
+        return self.indexes[field]
+
+    def lookup(self, field, value):
+        return self.index(field).get(value, [])
+
+    def fields(self):
+        if len(self.rows) == 0:
+            return []
+        return [x for x in self.rows[0].keys()]
+
+
+class StreamedReport():
+    """Report read from disk on every lookup to keep memory bounded"""
+    def __init__(self, name, file_path, streamer):
+        self.name = name
+        self.file_path = file_path
+        self.streamer = streamer
+
+    def is_stale(self, file_path):
+        return file_path != self.file_path
+
+    @property
+    def rows(self):
+        return self.streamer(self.file_path)
+
+    def lookup(self, field, value):
+        return [x for x in self.streamer(
+            self.file_path,
+            where=lambda row: field in row and row[field] == value)]
+
+    def fields(self):
+        for row in self.streamer(self.file_path):
+            return [x for x in row.keys()]
+        return []
+
+
+def close_report(report):
+    """Closes what a report holds open, such as a snapshot's sqlite file"""
+    close = getattr(report, 'close', None)
+    if close is not None:
+        close()
+
+
+class ReportStore():
+    """Loads each configured report once per run and serves indexed lookups.
+
+    A report is reloaded when its file's mtime or size changes. Rows are
+    shared between callers, so copy a row before changing it. modes maps a
+    report name to 'memory' (the default), 'stream', where each lookup scans
+    the file and nothing is kept, or 'snapshot', where rows are served from
+    an indexed sqlite file compiled next to the report.
+    """
+    def __init__(self, path_getter, loader, indexes=None, streamer=None,
+                 modes=None):
+        self.path_getter = path_getter
+        self.loader = loader
+        self.index_fields = REPORT_INDEXES if indexes is None else indexes
+        self.streamer = streamer
+        self.modes = {} if modes is None else modes
+        self.reports = {}
+        self.lock = threading.RLock()
+
+    def mode(self, name):
+        if self.streamer is None:
+            return 'memory'
+        return self.modes.get(name, 'memory')
+
+    def prepare(self, names=None, max_workers=None):
+        """Rebuilds every stale snapshot at once, one process per report"""
+        names = self.modes.keys() if names is None else names
+        jobs = []
+        for name in [x for x in names if self.mode(x) == 'snapshot']:
+            file_path = self.path_getter(name)
+            index_fields = self.index_fields.get(name, [])
+            if not is_fresh(file_path, name, index_fields):
+                jobs.append((file_path, name, index_fields))
+        if len(jobs) > 0:
+            build_snapshots(jobs, self.streamer, max_workers)
+
+    def get_report(self, name):
+        file_path = self.path_getter(name)
+        report = self.reports.get(name, None)
+        if report is not None and not report.is_stale(file_path):
+            return report
+        with self.lock:
+            report = self.reports.get(name, None)
+            if report is None or report.is_stale(file_path):
+                close_report(report)
+                report = self.load_report(name, file_path)
+                self.reports[name] = report
+            return report
+
+    def load_report(self, name, file_path):
+        mode = self.mode(name)
+        if mode == 'stream':
+            report = StreamedReport(name, file_path, self.streamer)
+        elif mode == 'snapshot':
+            report = SnapshotReport(
+                name,
+                file_path,
+                self.streamer,
+                self.index_fields.get(name, []))
+        else:
+            report = Report(
+                name,
+                file_path,
+                self.loader,
+                self.index_fields.get(name, []))
+        return report
+
+    def rows(self, name):
+        return self.get_report(name).rows
+
+    def lookup(self, name, field, value):
+        return self.get_report(name).lookup(field, value)
+
+    def fields(self, name):
+        return self.get_report(name).fields()
+
+    def clear(self, name=None):
+        with self.lock:
+            if name is None:
+                reports = [x for x in self.reports.values()]
+                self.reports = {}
+            else:
+                reports = [self.reports.pop(name, None)]
+        for report in reports:
+            close_report(report)
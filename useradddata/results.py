@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+import threading
+import time
+from datetime import datetime
+from .paths import write_atomic
+
+
+def row_fingerprint(values):
+    """Hash of a user add row's fields, the same whatever their order"""
+    text = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+class RowResults():
+    """Fingerprint and outcome of every user add row a run has processed.
+
+    rows maps an env to request ids, each with the fingerprint of the row
+    when it was last processed and that run's outcome. Rows are kept
+    across runs, since the open requests report is cumulative.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                self.rows = json.load(f).get('rows', {})
+        return self
+
+    def get(self, row, env):
+        return self.rows.get(env, {}).get(row, None)
+
+    def unchanged(self, row, env, fingerprint):
+        """Whether the row finished before and has not changed since"""
+        entry = self.get(row, env)
+        return entry is not None and entry['outcome'] == 'finished' and (
+            entry['fingerprint'] == fingerprint)
+
+    def note(self, row, env, fingerprint, outcome):
+        with self.lock:
+            self.rows.setdefault(env, {})[row] = {
+                'fingerprint': fingerprint,
+                'outcome': outcome,
+                'at': datetime.now().isoformat()}
+
+    def to_dict(self):
+        with self.lock:
+            return {'rows': self.rows}
+
+    def save(self):
+        return write_atomic(self.path, json.dumps(self.to_dict(), indent=3))
+
+
+class ResultSink():
+    """Appends one compact json line per Record to an NDJSON file.
+
+    Lines are flushed every flush_every Records or flush_seconds, so the
+    file can be tailed while a run goes on. Once it passes max_bytes it is
+    moved to path.1 (older ones to .2 and so on, keeping keep of them) and
+    a new file is started.
+    """
+    def __init__(self, path, flush_every=20, flush_seconds=5.0,
+                 max_bytes=64 * 1024 * 1024, keep=5):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.file = None
+        self.pending = 0
+        self.flushed = time.monotonic()
+        self.lock = threading.Lock()
+
+    def open(self):
+        self.file = open(self.path, 'a', encoding='utf8')
+        return self
+
+    def write(self, entry):
+        line = json.dumps(entry, separators=(',', ':'), default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.pending += 1
+            now = time.monotonic()
+            if self.pending >= self.flush_every or (
+                    now - self.flushed >= self.flush_seconds):
+                self.flush()
+                if self.file.tell() >= self.max_bytes:
+                    self.rotate()
+
+    def flush(self):
+        self.file.flush()
+        self.pending = 0
+        self.flushed = time.monotonic()
+
+    def rotate(self):
+        self.file.close()
+        for idx in range(self.keep - 1, 0, -1):
+            older = '%s.%d' % (self.path, idx)
+            if os.path.isfile(older):
+                os.replace(older, '%s.%d' % (self.path, idx + 1))
+        os.replace(self.path, '%s.1' % self.path)
+        self.open()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,80 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from .spaces import take_actions
+
+
+class Task():
+    """One step of a Record: a role's spaces, or a follow-up callable.
+
+    A task runs once every role it requires is finished with at least one
+    success, and is skipped when a required role has none.
+    """
+    def __init__(self, role, run, requires=()):
+        self.role = role
+        self.run = run
+        self.requires = tuple(requires)
+
+
+def role_task(record, role):
+    spaces = record.role_spaces(role)
+    requires = set()
+    for space in spaces:
+        requires.update(space.requires)
+
+    def run():
+        for space in spaces:
+            space.set_required_fields()
+        succeeded = take_actions(spaces)
+        record.finish_role(role)
+        return len(succeeded) > 0
+    return Task(role, run, requires)
+
+
+def record_tasks(record, deactivate_serials=False):
+    tasks = [
+        role_task(record, x) for x in record.SPACE_ROLES
+        if len(record.role_spaces(x)) > 0]
+    if len(record.stock) > 0:
+        tasks.append(Task(
+            'serials',
+            lambda: record.sync_serials(deactivate_serials),
+            ['stock']))
+    return tasks
+
+
+def run_tasks(tasks, max_workers=4):
+    """Runs tasks as their required roles finish, independent ones at once.
+
+    Returns the roles that succeeded.
+    """
+    remaining = {}
+    for task in tasks:
+        remaining[task.role] = remaining.get(task.role, 0) + 1
+    succeeded = set()
+    pending = [x for x in tasks]
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while len(pending) > 0 or len(running) > 0:
+            for task in [x for x in pending]:
+                if any(remaining.get(x, 0) > 0 for x in task.requires):
+                    continue
+                pending.remove(task)
+                missing = [x for x in task.requires if x not in succeeded]
+                if len(missing) > 0:
+                    print('Skipped %s: %s did not succeed.' % (
+                        task.role, ', '.join(missing)))
+                    remaining[task.role] -= 1
+                    continue
+                running[pool.submit(task.run)] = task
+            if len(running) == 0:
+                continue
+            done, not_done = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                remaining[task.role] -= 1
+                if future.result():
+                    succeeded.add(task.role)
+    return succeeded
+
+
+def run_record(record, max_workers=4, deactivate_serials=False):
+    return run_tasks(record_tasks(record, deactivate_serials), max_workers)
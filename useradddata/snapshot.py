@@ -0,0 +1,192 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+
+SNAPSHOT_VERSION = '1'
+SNAPSHOT_SUFFIX = '.snapshot.sqlite'
+ALL_FIELDS = '*'
+
+
+def file_stamp(file_path):
+    stat = os.stat(file_path)
+    return (stat.st_mtime, stat.st_size)
+
+
+def snapshot_path(file_path, name):
+    return '%s.%s%s' % (file_path, name, SNAPSHOT_SUFFIX)
+
+
+def file_hash(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_meta(path):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            return {k: v for k, v in conn.execute(
+                'SELECT key, value FROM meta')}
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+
+
+def is_fresh(file_path, name, index_fields):
+    """Checks the snapshot against the report's mtime, size and hash"""
+    meta = read_meta(snapshot_path(file_path, name))
+    if meta.get('version') != SNAPSHOT_VERSION:
+        return False
+    if meta.get('index_fields') != json.dumps(sorted(index_fields)):
+        return False
+    mtime, size = file_stamp(file_path)
+    if meta.get('size') != str(size):
+        return False
+    if meta.get('mtime') == repr(mtime):
+        return True
+    if meta.get('sha1') != file_hash(file_path):
+        return False
+    conn = sqlite3.connect(snapshot_path(file_path, name))
+    try:
+        with conn:
+            conn.execute(
+                "UPDATE meta SET value=? WHERE key='mtime'", (repr(mtime),))
+    finally:
+        conn.close()
+    return True
+
+
+def build_snapshot(file_path, name, streamer, index_fields):
+    """Decodes a report into an indexed sqlite file next to it"""
+    target = snapshot_path(file_path, name)
+    temp = '%s.%d.tmp' % (target, os.getpid())
+    if os.path.isfile(temp):
+        os.remove(temp)
+    mtime, size = file_stamp(file_path)
+    fields = []
+    conn = sqlite3.connect(temp)
+    try:
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE rows (id INTEGER PRIMARY KEY, data TEXT)')
+        conn.execute(
+            'CREATE TABLE keys (field TEXT, value TEXT, row INTEGER)')
+        rows = []
+        keys = []
+        every_field = ALL_FIELDS in index_fields
+        for idx, row in enumerate(streamer(file_path)):
+            if idx == 0:
+                fields = [x for x in row.keys()]
+            rows.append((idx, json.dumps(row)))
+            keys.extend([
+                (x, json.dumps(row[x]), idx)
+                for x in (row.keys() if every_field else index_fields)
+                if x in row])
+            if len(rows) >= 10000:
+                conn.executemany('INSERT INTO rows VALUES (?, ?)', rows)
+                conn.executemany('INSERT INTO keys VALUES (?, ?, ?)', keys)
+                rows = []
+                keys = []
+        conn.executemany('INSERT INTO rows VALUES (?, ?)', rows)
+        conn.executemany('INSERT INTO keys VALUES (?, ?, ?)', keys)
+        conn.execute('CREATE INDEX keys_lookup ON keys (field, value)')
+        conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('version', SNAPSHOT_VERSION),
+            ('mtime', repr(mtime)),
+            ('size', str(size)),
+            ('sha1', file_hash(file_path)),
+            ('index_fields', json.dumps(sorted(index_fields))),
+            ('fields', json.dumps(fields))])
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(temp, target)
+    return target
+
+
+def build_snapshots(jobs, streamer, max_workers=None):
+    """Builds several snapshots at once.
+
+    jobs are (file_path, name, index_fields) tuples. Decoding is CPU bound,
+    so each report is built in its own process; streamer must come from a
+    module that does not import main, such as decoding.iter_json_dict.
+    """
+    if len(jobs) == 1:
+        return [build_snapshot(jobs[0][0], jobs[0][1], streamer, jobs[0][2])]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(build_snapshot, x[0], x[1], streamer, x[2])
+            for x in jobs]
+        return [x.result() for x in futures]
+
+
+class SnapshotReport():
+    """Report served from its compiled sqlite snapshot.
+
+    Lookups on index_fields, or on any field when they hold ALL_FIELDS, use
+    the snapshot's index; others scan every row.
+    """
+    def __init__(self, name, file_path, streamer, index_fields=None):
+        self.name = name
+        self.file_path = file_path
+        self.index_fields = [] if index_fields is None else index_fields
+        if not is_fresh(file_path, name, self.index_fields):
+            build_snapshot(file_path, name, streamer, self.index_fields)
+        self.stamp = file_stamp(file_path)
+        self.lock = threading.Lock()
+        self.conn = self.connect()
+        self.meta = {k: v for k, v in self.conn.execute(
+            'SELECT key, value FROM meta')}
+
+    def connect(self):
+        return sqlite3.connect(
+            snapshot_path(self.file_path, self.name), check_same_thread=False)
+
+    def close(self):
+        """Closes the sqlite file; a later query opens it again"""
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def is_stale(self, file_path):
+        if file_path != self.file_path:
+            return True
+        try:
+            return file_stamp(file_path) != self.stamp
+        except OSError:
+            return True
+
+    def query(self, sql, params=()):
+        with self.lock:
+            if self.conn is None:
+                self.conn = self.connect()
+            return [json.loads(x[0]) for x in self.conn.execute(sql, params)]
+
+    @property
+    def rows(self):
+        return self.query('SELECT data FROM rows ORDER BY id')
+
+    def is_indexed(self, field):
+        return field in self.index_fields or ALL_FIELDS in self.index_fields
+
+    def lookup(self, field, value):
+        if not self.is_indexed(field):
+            return [
+                x for x in self.rows if field in x and x[field] == value]
+        return self.query(
+            'SELECT rows.data FROM keys JOIN rows ON rows.id = keys.row '
+            'WHERE keys.field = ? AND keys.value = ? ORDER BY rows.id',
+            (field, json.dumps(value)))
+
+    def fields(self):
+        return json.loads(self.meta.get('fields', '[]'))
@@ -3,4 +3,7 @@ from .user import UserSpace
 from .permissionset import PermissionSetSpace
 from .site import LocationSpace, matching_locations
 from .tech import TechSpace
-from .stock import add_stock, ProductStockSpace, SerializedStockSpace
+from .stock import (
+    add_stock, ProductStockSpace, SerializedStockSpace, SiteStock)
+from .bulk import take_actions
+from .serials import SerialDiff, reconcile_serials
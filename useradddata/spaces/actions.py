@@ -1,3 +1,8 @@
+from .. import journal
+from .. import querycache
+from .. import ratelimit
+
+
 class Action():
     def __init__(self, space, name, desc):
         self.space = space
@@ -14,6 +19,22 @@ class Action():
         print('No Action defined for %s', self.name.title())
         return False
 
+    def written(self, sfid):
+        """Forgets cached lookups of the record just written"""
+        querycache.invalidate(
+            self.space.record.conn,
+            self.space.sobject,
+            [{**self.space.to_dict(), 'Id': sfid}])
+
+    def done(self, previous, success=False):
+        """Marks the space done and journals the outcome"""
+        setattr(
+            self.space,
+            'action',
+            DoneAction(self.space, previous, success))
+        journal.note_action(self.space, previous, success)
+        return success
+
 
 class InsertAction(Action):
     def __init__(self, space):
@@ -21,26 +42,32 @@ class InsertAction(Action):
         desc = 'Insert new record'
         super(InsertAction, self).__init__(space, name, desc)
 
+    def payload(self):
+        return self.space.to_dict()
+
     def take_action(self):
         url = '%s/services/data/v40.0/sobjects/%s/' % (
             self.space.record.conn.auth['instance_url'],
             self.space.sobject)
         try:
-            response = self.space.record.conn.req_post(
-                url, self.space.to_dict())
-            setattr(self.space, 'sfid', response['id'])
-            setattr(
-                self.space,
-                'action',
-                DoneAction(self.space, 'inserted', True))
-            return True
+            conn = self.space.record.conn
+            response = ratelimit.limited(
+                conn, 'insert', self.space.sobject,
+                lambda: conn.req_post(url, self.payload()))
+            self.written(response['id'])
+            return self.succeed(response['id'])
+        except ratelimit.ApiLimitReached:
+            raise
         except Exception as e:
             print(e)
-            setattr(
-                self.space,
-                'action',
-                DoneAction(self.space, 'inserted'))
-            return False
+            return self.fail()
+
+    def succeed(self, sfid):
+        setattr(self.space, 'sfid', sfid)
+        return self.done('inserted', True)
+
+    def fail(self):
+        return self.done('inserted')
 
 
 class UpdateAction(Action):
@@ -51,32 +78,39 @@ class UpdateAction(Action):
         self.sfid = sfid
         super(UpdateAction, self).__init__(space, name, desc)
 
-    def take_action(self):
+    def payload(self):
         payload = self.space.to_dict()
         payload = {k: v for k, v in payload.items() if k != 'Id'}
         if hasattr(self, 'IsActive'):
             payload['IsActive'] = 'true'
+        return payload
+
+    def take_action(self):
         url = '%s/services/data/v40.0/sobjects/%s/%s' % (
             self.space.record.conn.auth['instance_url'],
             self.space.sobject,
             self.sfid)
         try:
-            response = self.space.record.conn.req_patch(url, payload)
+            conn = self.space.record.conn
+            response = ratelimit.limited(
+                conn, 'update', self.space.sobject,
+                lambda: conn.req_patch(url, self.payload()))
             if response.status_code > 299:
                 raise RuntimeError(str(response))
-            setattr(self.space, 'sfid', self.sfid)
-            setattr(
-                self.space,
-                'action',
-                DoneAction(self.space, 'updated', True))
-            return True
+            self.written(self.sfid)
+            return self.succeed(self.sfid)
+        except ratelimit.ApiLimitReached:
+            raise
         except Exception as e:
             print(e)
-            setattr(
-                self.space,
-                'action',
-                DoneAction(self.space, 'updated'))
-            return False
+            return self.fail()
+
+    def succeed(self, sfid):
+        setattr(self.space, 'sfid', sfid)
+        return self.done('updated', True)
+
+    def fail(self):
+        return self.done('updated')
 
 
 class SkipAction(Action):
@@ -85,11 +119,7 @@ class SkipAction(Action):
         super(SkipAction, self).__init__(space, 'skip', desc)
 
     def take_action(self):
-        setattr(
-            self.space,
-            'action',
-            DoneAction(self.space, 'skipped', True))
-        return True
+        return self.done('skipped', True)
 
 
 class DoneAction(Action):
@@ -97,6 +127,8 @@ class DoneAction(Action):
         desc = 'Successfully' if success else 'Unsuccessfully'
         desc = '%s %s %s: %s' % (
             desc, previous, space.sobject, getattr(space, 'sfid', ''))
+        self.previous = previous
+        self.success = success
         super(DoneAction, self).__init__(space, 'done', desc)
 
     def take_action(self):
@@ -0,0 +1,137 @@
+from .. import lookups
+from .. import querycache
+from .. import ratelimit
+from .actions import DoneAction, InsertAction, UpdateAction
+
+
+COLLECTION_SIZE = 200
+COLLECTION_URL = '%s/services/data/v42.0/composite/sobjects'
+
+
+def collection_url(conn):
+    return COLLECTION_URL % conn.auth['instance_url']
+
+
+def failed_results(payloads, error):
+    return [
+        {'id': None, 'success': False, 'errors': [{'message': str(error)}]}
+        for x in payloads]
+
+
+def collection_body(sobject, payloads):
+    return {
+        'allOrNone': False,
+        'records': [
+            {'attributes': {'type': sobject}, **x} for x in payloads]}
+
+
+def insert_records(conn, sobject, payloads):
+    """Inserts payloads through sObject Collections, 200 per request.
+
+    Returns one result ({'id', 'success', 'errors'}) per payload, in order.
+    """
+    results = []
+    for idx in range(0, len(payloads), COLLECTION_SIZE):
+        chunk = payloads[idx:idx + COLLECTION_SIZE]
+        try:
+            response = ratelimit.limited(
+                conn, 'collection_insert', sobject, lambda: conn.req_post(
+                    collection_url(conn), collection_body(sobject, chunk)))
+            if not isinstance(response, list):
+                raise RuntimeError(str(response))
+            results.extend(response)
+        except ratelimit.ApiLimitReached:
+            raise
+        except Exception as e:
+            print(e)
+            results.extend(failed_results(chunk, e))
+    return results
+
+
+def update_records(conn, sobject, payloads):
+    """Updates payloads, which must hold their Id, 200 per request"""
+    results = []
+    for idx in range(0, len(payloads), COLLECTION_SIZE):
+        chunk = payloads[idx:idx + COLLECTION_SIZE]
+        try:
+            response = ratelimit.limited(
+                conn, 'collection_update', sobject, lambda: conn.req_patch(
+                    collection_url(conn), collection_body(sobject, chunk)))
+            if response.status_code > 299:
+                raise RuntimeError(str(response))
+            results.extend(response.json())
+        except ratelimit.ApiLimitReached:
+            raise
+        except Exception as e:
+            print(e)
+            results.extend(failed_results(chunk, e))
+    return results
+
+
+def error_messages(result):
+    return '; '.join([
+        x.get('message', str(x)) for x in result.get('errors', [])])
+
+
+def take_actions(spaces):
+    """Takes the actions of many spaces at once.
+
+    Each space is validated as in RecordSpace.take_action, after the Id
+    values of all of them are announced and fetched together. Inserts and
+    updates are grouped by connection and sobject and sent as collections;
+    the ids and errors that come back are set on each space through its
+    action. Spaces already done are not sent again. Returns the spaces
+    whose action succeeded.
+    """
+    groups = {}
+    seen = set()
+    succeeded = []
+    to_take = []
+    for space in spaces:
+        if id(space) in seen:
+            continue
+        seen.add(id(space))
+        if isinstance(space.action, DoneAction):
+            if space.action.success:
+                succeeded.append(space)
+            continue
+        if space.action is None:
+            space.action = space.determine_action()
+        space.want_validation()
+        to_take.append(space)
+    lookups.dispatch_all()
+    for space in to_take:
+        space.validate()
+        if not space.valid:
+            continue
+        if isinstance(space.action, (InsertAction, UpdateAction)):
+            key = (id(space.record.conn), space.sobject, type(space.action))
+            groups.setdefault(key, []).append(space)
+        elif space.action.take_action():
+            succeeded.append(space)
+    for key, group in groups.items():
+        conn = group[0].record.conn
+        actions = [x.action for x in group]
+        if key[2] is InsertAction:
+            results = insert_records(
+                conn, key[1], [x.payload() for x in actions])
+        else:
+            results = update_records(
+                conn,
+                key[1],
+                [{**x.payload(), 'Id': x.sfid} for x in actions])
+        written = []
+        for space, action, result in zip(group, actions, results):
+            if result.get('success', False):
+                action.succeed(
+                    result.get('id', None) or getattr(action, 'sfid', None))
+                succeeded.append(space)
+                written.append({**space.to_dict(), 'Id': space.sfid})
+            else:
+                print('Could not %s %s %s: %s' % (
+                    action.name, space.sobject, space.get_name(),
+                    error_messages(result)))
+                action.fail()
+        if len(written) > 0:
+            querycache.invalidate(conn, key[1], written)
+    return succeeded
@@ -1,6 +1,11 @@
 import force as sf
-from ..validation import ForceDef
-from .actions import InsertAction, UpdateAction, SkipAction
+from .. import lookups
+from .. import metrics
+from .. import ratelimit
+from ..connections import format_env
+from ..decisions import get_policy
+from ..validation import get_force_def
+from .actions import DoneAction, InsertAction, UpdateAction, SkipAction
 
 
 def is_int(param):
@@ -23,29 +28,75 @@ def error_if_none(message):
 
 
 class RecordSpace():
+    """Fields of one sobject record, read and set as attributes.
+
+    Field values live in the ordered values dict, so a field set twice is
+    stored once; excluded and valid_fields are sets.
+    """
+    __slots__ = [
+        'values', 'record', 'action', 'valid', 'problems', 'sfid', 'sobject',
+        'matching_terms', 'description', 'excluded', 'valid_fields']
+    requires = ()
+
     def __init__(self, parent, sobject, *args, **kwargs):
+        self.values = {}
         self.record = parent
         self.action = None
         self.valid = False
+        self.problems = {}
         self.sfid = None
         self.sobject = sobject if sobject != 'Ref' else None
-        self.fields = [] if not hasattr(self, 'fields') else self.fields
         for field in args:
-            self.fields.append(field.name)
-            setattr(self, field.name, field.value)
+            self.add_field(field.name, field.value)
         self.fields_from_dict(kwargs)
         self.matching_terms = getattr(self, 'matching_terms', [])
         self.description = None
-        self.excluded = []
-        self.valid_fields = []
+        self.excluded = set()
+        self.valid_fields = set()
+
+    def __getattr__(self, name):
+        if name == 'values':
+            raise AttributeError(name)
+        try:
+            return self.values[name]
+        except KeyError:
+            raise AttributeError(
+                "'%s' has no field '%s'" % (type(self).__name__, name))
+
+    def __setattr__(self, name, value):
+        try:
+            values = object.__getattribute__(self, 'values')
+        except AttributeError:
+            values = {}
+        if name in values:
+            values[name] = value
+        else:
+            object.__setattr__(self, name, value)
+
+    @property
+    def fields(self):
+        return self.values.keys()
+
+    def add_field(self, name, value=None):
+        self.values[name] = value
+
+    def remove_field(self, name):
+        """Drops a field, returning its value"""
+        self.excluded.discard(name)
+        self.valid_fields.discard(name)
+        return self.values.pop(name, None)
 
     def get_name(self):
         fallback = 'unnamed %s' % self.sobject
         return getattr(self, 'name', fallback)
 
+    def journal_key(self):
+        """Tells this space from the row's others of its sobject"""
+        return self.get_name()
+
     def to_dict(self):
         return {
-            x: getattr(self, x) for x in self.fields if x not in self.excluded}
+            k: v for k, v in self.values.items() if k not in self.excluded}
 
     def take_action(self):
         if self.action is None:
@@ -71,6 +122,15 @@ class RecordSpace():
         return UpdateAction(self, self.sfid)
 
     def choose_match(self, matches):
+        context = {**self.to_dict(), 'sobject': self.sobject}
+        selection = get_policy().choose(
+            'choose_match',
+            matches,
+            context,
+            lambda: self.prompt_match(matches))
+        return None if selection is None else matches[selection]
+
+    def prompt_match(self, matches):
         display_fields = ['Id']
         display_fields.extend(self.matching_terms)
         filtered = [
@@ -82,55 +142,70 @@ class RecordSpace():
                 ["%s: %s" % (k, str(v)) for k, v in filtered[i].items()])
             print("%d.\t\t%s" % (i, display_match))
         selection = input('Choose option (or leave blank): ')
-        match = None
         try:
-            match = matches[int(selection)]
+            matches[int(selection)]
+            return int(selection)
         except Exception as e:
-            pass
-        return match
+            return None
 
     def merge_with_match(self, match):
         for key, value in match.items():
             not_found = None if value is not None else '_'
             if value == getattr(self, key, not_found):
-                self.excluded.append(key)
-        if hasattr(self, 'IsActive'):
-            setattr(self, 'IsActive', 'true')
-            self.excluded = [x for x in self.excluded if x != 'IsActive']
+                self.excluded.add(key)
+        if 'IsActive' in self.values:
+            self.IsActive = 'true'
+            self.excluded.discard('IsActive')
         self.sfid = match['Id']
-        if len(self.fields) == len(self.excluded):
+        if self.excluded.issuperset(self.values.keys()):
             self.action = 'Done'
             return
-        self.fields.append("Id")
-        setattr(self, 'Id', match['Id'])
-        self.valid_fields.append('Id')
+        self.add_field('Id', match['Id'])
+        self.valid_fields.add('Id')
         self.action = 'Update'
 
-    def get_matching_sfids(self):
-        if len(self.matching_terms) == 0:
-            return []
-        sfids = sf.SOSL(
-            self.record.conn,
-            terms=[getattr(self, x) for x in self.matching_terms],
-            sobject=self.sobject,
-            join_terms_on='OR').get_results()
-        return [x['Id'] for x in sfids if x.get('Id', None) is not None]
+    def match_fields(self):
+        fields = ['Id']
+        fields.extend([x for x in self.fields if x != 'Id'])
+        return fields
+
+    def want_matches(self):
+        """Announces this space's matching terms to the batch lookups"""
+        if self.sobject is None:
+            return
+        for term in self.matching_terms:
+            lookups.want_one(
+                self.record.conn,
+                self.sobject,
+                term,
+                getattr(self, term, None),
+                self.match_fields())
 
     def get_matches_from_force(self):
-        sfids = self.get_matching_sfids()
-        if len(sfids) == 0:
-            return []
-        filters = "Id IN ('%s')" % "','".join(sfids)
-        fields = ["Id"]
-        fields.extend(self.fields)
-        return sf.SOQL(
-            self.record.conn,
-            fields=fields,
-            sobject=self.sobject,
-            filters=filters).get_results()
+        """Rows whose matching term fields equal this space's values.
+
+        Terms announced with want_matches across the run are fetched
+        together, a few IN queries per sobject and term field.
+        """
+        matches = []
+        seen = set()
+        for term in self.matching_terms:
+            found = lookups.load_one(
+                self.record.conn,
+                self.sobject,
+                term,
+                getattr(self, term, None),
+                self.match_fields())
+            for row in found:
+                if row['Id'] not in seen:
+                    seen.add(row['Id'])
+                    matches.append(row)
+        return matches
 
     def describe(self):
-        self.description = sf.ForceDescription(self.record.conn, self.sobject)
+        self.description = ratelimit.limited(
+            self.record.conn, 'describe', self.sobject,
+            lambda: sf.ForceDescription(self.record.conn, self.sobject))
 
     def get_rules(self):
         env = self.record.ref.Environment
@@ -141,18 +216,34 @@ class RecordSpace():
         return {k: v.environments[env] for k, v in rules.items()}
 
     def validate(self):
-        to_check = {
-            x: getattr(self, x) for x in self.fields
-            if x not in self.valid_fields}
-        desc = ForceDef(
-            sobject=self.sobject,
-            fields=[x for x in to_check.keys()])
+        with metrics.timer(
+                'validate_seconds',
+                sobject=self.sobject,
+                env=format_env(self.record.ref.Environment)):
+            return self.validate_fields()
+
+    def fields_to_check(self):
+        return {
+            k: v for k, v in self.values.items()
+            if k not in self.valid_fields}
+
+    def want_validation(self):
+        """Announces the Id values validate will look up"""
+        to_check = self.fields_to_check()
+        desc = get_force_def(self.sobject, [x for x in to_check.keys()])
+        desc.want_ids(self.record.ref.Environment, to_check)
+
+    def validate_fields(self):
+        to_check = self.fields_to_check()
+        desc = get_force_def(self.sobject, [x for x in to_check.keys()])
         good, problems = desc.check_values(
             self.record.ref.Environment,
             to_check)
         for key, val in good.items():
-            setattr(self, key, val)
+            self.values[key] = val
         self.valid = len(problems.keys()) == 0
+        self.problems = {
+            k: {'value': v[0], 'reasons': v[1]} for k, v in problems.items()}
         for field in problems.keys():
             msg1 = "Could not validate '%s' for %s.%s" % (
                 problems[field][0], self.sobject, field)
@@ -161,9 +252,16 @@ class RecordSpace():
         return self.valid
 
     def fields_from_dict(self, given):
-        for key, value in given.items():
-            self.fields.append(key)
-            setattr(self, key, value)
+        self.values.update(given)
+
+    def set_required_fields(self):
+        """Copies ids from the Record roles this space requires"""
+        if isinstance(self.action, DoneAction):
+            return
+        if 'user' in self.requires:
+            self.set_user_fields()
+        if 'sites' in self.requires:
+            self.set_locn_fields()
 
     def set_user_fields(self):
         pass
@@ -1,21 +1,33 @@
-import force as sf
+from .. import lookups
+from .. import querycache
 from .main import RecordSpace
 from .actions import InsertAction, SkipAction
 
 
 class PermissionSetSpace(RecordSpace):
+    requires = ('user',)
+
     def __init__(self, record, permission_set_id):
-        self.fields = ['AssigneeId', 'PermissionSetId']
-        self.PermissionSetId = permission_set_id.strip()
-        self.AssigneeId = None
-        self.stored_permission_label = 'unknown permission set'
         super(PermissionSetSpace, self).__init__(
-            record, 'PermissionSetAssignment')
+            record,
+            'PermissionSetAssignment',
+            AssigneeId=None,
+            PermissionSetId=permission_set_id.strip())
+        self.stored_permission_label = 'unknown permission set'
+        lookups.want_one(
+            self.record.conn,
+            'PermissionSet',
+            'Id',
+            self.PermissionSetId,
+            ['Id', 'Label'])
 
     def get_name(self):
         return "%s permission for %s" % (
             self.stored_permission_label, self.record.user.get_name())
 
+    def journal_key(self):
+        return self.PermissionSetId
+
     def set_user_fields(self):
         user_id = self.record.ref.SF_User_Id
         self.AssigneeId = user_id
@@ -23,24 +35,34 @@ class PermissionSetSpace(RecordSpace):
 
     def handle_matches(self):
         filters = ["%s='%s'" % (x, getattr(self, x, '')) for x in self.fields]
-        matches = sf.SOQL(
-            self.record.conn,
-            fields=['Id'],
-            sobject=self.sobject,
-            filters=filters).get_results()
+        matches = querycache.soql(
+            self.record.conn, ['Id'], self.sobject, filters)
         return SkipAction(self) if len(matches) > 0 else InsertAction(
             self)
 
+    def want_validation(self):
+        lookups.want_one(
+            self.record.conn,
+            'User',
+            'Id',
+            getattr(self, 'AssigneeId', None),
+            ['Id', 'Username'])
+
     def validate(self):
-        self.valid = self.validate_permissionset() and self.validate_user()
+        self.problems = {}
+        if not self.validate_permissionset():
+            self.problems['PermissionSetId'] = {
+                'value': self.PermissionSetId,
+                'reasons': ['no such permission set']}
+        elif not self.validate_user():
+            self.problems['AssigneeId'] = {
+                'value': self.AssigneeId, 'reasons': ['no such user']}
+        self.valid = len(self.problems) == 0
 
     def user_lookup(self):
         user_id = getattr(self, 'AssigneeId', '')
-        return sf.SOQL(
-            self.record.conn,
-            fields=['Id', 'Username'],
-            sobject='User',
-            filters=["Id='%s'" % user_id]).get_results()
+        return lookups.load_one(
+            self.record.conn, 'User', 'Id', user_id, ['Id', 'Username'])
 
     def validate_user(self):
         user = self.user_lookup()
@@ -55,8 +77,9 @@ class PermissionSetSpace(RecordSpace):
 
     def permissionset_lookup(self):
         permission_set_id = getattr(self, 'PermissionSetId', '')
-        return sf.SOQL(
+        return lookups.load_one(
             self.record.conn,
-            fields=['Id', 'Label'],
-            sobject='PermissionSet',
-            filters=["Id='%s'" % permission_set_id]).get_results()
+            'PermissionSet',
+            'Id',
+            permission_set_id,
+            ['Id', 'Label'])
@@ -0,0 +1,115 @@
+from .. import lookups
+from .actions import InsertAction, UpdateAction
+from .stock import SerializedStockSpace
+
+
+SERIAL_FIELDS = [
+    'Id', 'Name', 'SVMXC__Active__c', 'SVMXC__Product_Stock__c']
+
+
+def serial_key(name):
+    return None if name is None else str(name).strip().lower()
+
+
+class SerialDiff():
+    """Serials to change so a technician's stock matches the report.
+
+    Serials are matched on Name within their product stock. Names the
+    report holds that are missing are inserted, inactive ones are made
+    active again, and with deactivate, active serials the report no longer
+    holds are made inactive. Running it again finds nothing to do.
+    """
+    def __init__(self, record, deactivate=False):
+        self.record = record
+        self.deactivate = deactivate
+        self.inserts = []
+        self.reactivations = []
+        self.deactivations = []
+
+    def items(self):
+        """(product stock, serial) pairs, in insert, update order"""
+        rtn = []
+        rtn.extend(self.inserts)
+        rtn.extend(self.reactivations)
+        rtn.extend(self.deactivations)
+        return rtn
+
+    def spaces(self):
+        return [x[1] for x in self.items()]
+
+    def summary(self):
+        return '%d serials to insert, %d to reactivate, %d to deactivate' % (
+            len(self.inserts),
+            len(self.reactivations),
+            len(self.deactivations))
+
+    def existing(self):
+        """Existing serials by product stock Id.
+
+        They come from the Record's site stock when it was loaded, and
+        otherwise from one query per 200 product stock.
+        """
+        stocks = [x for x in self.record.stock if x.sfid is not None]
+        site_stock = getattr(self.record, 'site_stock', None)
+        if site_stock is not None:
+            return {x.sfid: site_stock.find_serials(x.sfid) for x in stocks}
+        for stock in stocks:
+            lookups.want_one(
+                self.record.conn,
+                'SVMXC__Product_Serial__c',
+                'SVMXC__Product_Stock__c',
+                stock.sfid,
+                SERIAL_FIELDS)
+        return {
+            x.sfid: lookups.load_one(
+                self.record.conn,
+                'SVMXC__Product_Serial__c',
+                'SVMXC__Product_Stock__c',
+                x.sfid,
+                SERIAL_FIELDS)
+            for x in stocks}
+
+    def compute(self):
+        """Compares only product stock with an Id, since serials need one"""
+        existing = self.existing()
+        for stock in self.record.stock:
+            if stock.sfid is not None:
+                self.compare(stock, existing[stock.sfid])
+        return self
+
+    def compare(self, stock, rows):
+        wanted = stock.wanted_serials()
+        wanted_keys = set([serial_key(x) for x in wanted])
+        found = {serial_key(x['Name']): x for x in rows}
+        for name in wanted:
+            row = found.get(serial_key(name), None)
+            if row is None:
+                space = self.make_serial(stock, {'Name': name})
+                space.action = InsertAction(space)
+                self.inserts.append((stock, space))
+            elif not row.get('SVMXC__Active__c', True):
+                self.reactivations.append(
+                    (stock, self.make_update(stock, row, True)))
+        if not self.deactivate:
+            return
+        for key, row in found.items():
+            if key not in wanted_keys and row.get('SVMXC__Active__c', True):
+                self.deactivations.append(
+                    (stock, self.make_update(stock, row, False)))
+
+    def make_serial(self, stock, row):
+        space = SerializedStockSpace(self.record, row)
+        space.SVMXC__Product_Stock__c = stock.sfid
+        space.SVMXC__Product__c = stock.SVMXC__Product__c
+        return space
+
+    def make_update(self, stock, row, active):
+        space = self.make_serial(stock, row)
+        space.SVMXC__Active__c = active
+        space.sfid = row['Id']
+        space.action = UpdateAction(space, row['Id'])
+        return space
+
+
+def reconcile_serials(record, deactivate=False):
+    return SerialDiff(record, deactivate).compute()
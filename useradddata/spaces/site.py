@@ -1,4 +1,5 @@
-import force as sf
+from .. import lookups
+from .. import ratelimit
 from .. import main as util
 from .main import RecordSpace, error_if_none
 
@@ -17,17 +18,20 @@ def matching_locations(record):
     if search_for in ['', None]:
         return []
     search_fields = ['Location_Number__c', 'Oracle_Ship_to_Number__c']
-    known = util.import_json_dict(util.report_file_path('locations'))
-    search_fields.extend(
-        [k for k in known[0].keys() if k not in search_fields])
+    search_fields.extend([
+        k for k in util.report_store.fields('locations')
+        if k not in search_fields])
     matches = []
     while len(matches) == 0 and len(search_fields) > 0:
         search_field = search_fields.pop(0)
-        matches.extend([x for x in known if x[search_field] == search_for])
+        matches.extend(util.report_store.lookup(
+            'locations', search_field, search_for))
     return [LocationSpace(record, x) for x in matches]
 
 
 class LocationSpace(RecordSpace):
+    requires = ('user',)
+
     def __init__(self, record, match=None):
         self.matching_terms = ['Name']
         super(LocationSpace, self).__init__(
@@ -36,30 +40,36 @@ class LocationSpace(RecordSpace):
         self.fields_from_dict(match)
         self.fields_from_dict(LOCN_DEFAULTS)
         self.fields_from_dict(self._get_context_fields())
-        self.fields = [x for x in self.fields if x != 'SITE_USE_ID']
-        self.valid_fields.extend(
+        self.site_use_id = self.remove_field('SITE_USE_ID')
+        self.valid_fields.update(
             [k for k, v in LOCN_DEFAULTS.items() if v is not None])
+        lookups.want_one(
+            self.record.conn,
+            'BusinessHours',
+            'Name',
+            self.SVMXC__Preferred_Business_Hours__c,
+            ['Id', 'Name'])
 
     def get_name(self):
-        suid = getattr(self, 'SITE_USE_ID', None)
+        suid = self.site_use_id
         suid = '' if suid is None else ' (%s)' % suid
         return "%s%s" % (self.Name, suid)
 
     def lookup_biz_hrs(self):
         field_name = 'SVMXC__Preferred_Business_Hours__c'
-        findings = sf.SOQL(
+        findings = lookups.load_one(
             self.record.conn,
-            filters=["name = '%s'" % getattr(self, field_name)],
-            sobject='BusinessHours').get_results()
+            'BusinessHours',
+            'Name',
+            getattr(self, field_name),
+            ['Id', 'Name'])
         if len(findings) == 0:
-            self.valid_fields = [
-                x for x in self.valid_fields if x != field_name]
+            self.valid_fields.discard(field_name)
             return
         setattr(self, field_name, findings[0]['Id'])
 
     def validate(self):
         self.lookup_biz_hrs()
-        self.fields = [x for x in self.fields if x != 'SITE_USE_ID']
         super(LocationSpace, self).validate()
 
     @error_if_none('No Location Given')
@@ -80,14 +90,12 @@ class LocationSpace(RecordSpace):
             'Name': self._get_location_name()}
 
     def _get_match(self):
-        known = util.import_json_dict(util.report_file_path('locations'))
-        matches = [
-            x for x in known
-            if x['Location_Number__c'] == self._get_location()]
+        location = self._get_location()
+        matches = [x for x in util.report_store.lookup(
+            'locations', 'Location_Number__c', location)]
         if len(matches) == 0:
-            matches.extend([
-                x for x in known
-                if x['Oracle_Ship_to_Number__c'] == self._get_location()])
+            matches.extend(util.report_store.lookup(
+                'locations', 'Oracle_Ship_to_Number__c', location))
         if len(matches) == 0:
             return None
         match = matches.pop(0)
@@ -98,7 +106,9 @@ class LocationSpace(RecordSpace):
     def make_alt_match(self, alt):
         try:
             space = LocationSpace(self.record, alt)
-            self.record.spaces.append(space)
+            self.record.sites.append(space)
+        except ratelimit.ApiLimitReached:
+            raise
         except Exception as e:
             pass
 
@@ -1,6 +1,8 @@
-import force as sf
 from .main import RecordSpace, is_int
+from .actions import SkipAction, UpdateAction
 from .. import main as util
+from .. import querycache
+from ..lookups import lookup_key, quote
 
 
 STOCK_DEFAULTS = {
@@ -8,6 +10,13 @@ STOCK_DEFAULTS = {
     'SVMXC__Location__c': None}
 
 
+SERIAL_RELATIONSHIP = 'SVMXC__Product_Serial__r'
+SITE_STOCK_QUERY = (
+    "SELECT Id, SVMXC__Product__c, SVMXC__Quantity2__c, SVMXC__Status__c, "
+    "(SELECT Id, Name, SVMXC__Active__c, SVMXC__Product_Stock__c "
+    "FROM %s) FROM SVMXC__Product_Stock__c WHERE SVMXC__Location__c='%s'")
+
+
 SER_STOCK_DEFAULTS = {
     'SVMXC__Active__c': True,
     'SVMXC__Product_Stock__c': None,
@@ -18,71 +27,96 @@ def add_stock(record):
     subInv = getattr(record.ref, 'Oracle_SubInventory', None)
     if subInv is None:
         return
-    known = util.import_json_dict(util.report_file_path('prod_stock'))
-    record.stock = [
-        ProductStockSpace(record, x) for x in known
-        if x['Subinventory'] == subInv]
+    known = util.report_store.lookup('prod_stock', 'Subinventory', subInv)
+    record.stock = [ProductStockSpace(record, x) for x in known]
+
+
+class SiteStock():
+    """Product stock already at a site and its serials, from one query"""
+    def __init__(self, conn, site_id):
+        self.conn = conn
+        self.site_id = site_id
+        self.stock = {}
+        self.serials = {}
+
+    def load(self):
+        rows = querycache.query_all(
+            self.conn,
+            SITE_STOCK_QUERY % (SERIAL_RELATIONSHIP, quote(self.site_id)),
+            'SVMXC__Product_Stock__c')
+        for row in rows:
+            serials = row.get(SERIAL_RELATIONSHIP, None) or []
+            row = {
+                k: v for k, v in row.items()
+                if k not in ['attributes', SERIAL_RELATIONSHIP]}
+            key = self.stock_key(
+                row['SVMXC__Product__c'], row['SVMXC__Status__c'])
+            self.stock.setdefault(key, row)
+            self.serials[lookup_key('Id', row['Id'])] = [
+                {k: v for k, v in x.items() if k != 'attributes'}
+                for x in serials]
+        return self
+
+    def stock_key(self, product_id, status):
+        return (lookup_key('Id', product_id), status)
+
+    def find_stock(self, product_id, status):
+        return self.stock.get(self.stock_key(product_id, status), None)
+
+    def find_serials(self, stock_id):
+        return self.serials.get(lookup_key('Id', stock_id), [])
 
 
 class ProductStockSpace(RecordSpace):
+    requires = ('sites',)
+
     def __init__(self, record, stock):
         super(ProductStockSpace, self).__init__(
             record, 'SVMXC__Product_Stock__c')
         self.fields_from_dict(STOCK_DEFAULTS)
         self.key = stock.get('key')
-        self.ser_stock = []
         self.fields_from_dict({
             k: v for k, v in stock.items()
             if k in ['SVMXC__Product__c', 'SVMXC__Quantity2__c']
             })
-        self.valid_fields.append('SVMXC__Status__c')
+        self.valid_fields.add('SVMXC__Status__c')
 
     def get_name(self):
         return self.key
 
-    def take_action(self):
-        super(ProductStockSpace, self).take_action()
-        self.get_ser_stock()
-        for ser in self.ser_stock:
-            ser.SVMXC__Product_Stock__c = self.sfid
-            ser.SVMXC__Product__c = self.SVMXC__Product__c
-            ser.take_action()
-
-    def get_ser_stock(self):
-        sers = list(filter(
-            (lambda x: x.get('Key', 'not_a_key') == self.key),
-            util.import_json_dict(util.report_file_path('ser_stock'))))
-        sers = list(filter(
-            (lambda x: is_int(x.get('OnHand', None))), sers))
-        for ser in sers:
-            ser['OnHand'] = int(ser['OnHand']) - self.existing_ser_count()
-        sers = list(filter((lambda x: x['OnHand'] > 0), sers))
-        for ser in sers:
-            self.ser_stock.extend(
-                [SerializedStockSpace(self.record, ser)] * ser['OnHand'])
-
-    def existing_ser_count(self):
-        filters = "SVMXC__Product_Stock__c='%s'" % self.sfid
-        try:
-            existing = sf.SOQL(
-                self.record.conn,
-                fields=["Id"],
-                sobject='SVMXC__Product_Serial__c',
-                filters=filters).get_results()
-            return len(existing)
-        except Exception as e:
-            print('Error looking up existing stock:\n', str(e))
-            print('Please check SF record and enter number found:\n')
-            print('%s/%s' % (
-                self.record.conn.auth['instance_url'], self.sfid))
-            return int(input('Serailized Stock records: '))
+    def wanted_serials(self):
+        """Serial Names the report holds on hand for this product stock"""
+        names = []
+        for row in util.report_store.lookup('ser_stock', 'Key', self.key):
+            name = row.get('Name', None)
+            if not is_int(row.get('OnHand', None)) or int(row['OnHand']) < 1:
+                continue
+            if name in ['', None]:
+                continue
+            if str(name).strip() not in names:
+                names.append(str(name).strip())
+        return names
 
     def set_locn_fields(self):
         locn = self.record.sites[0]
         self.SVMXC__Location__c = locn.sfid
 
+    def match_site_stock(self, site_stock):
+        """Updates the site's product stock for this product, if it has one"""
+        row = site_stock.find_stock(
+            self.SVMXC__Product__c, self.SVMXC__Status__c)
+        if row is None or self.action is not None:
+            return
+        self.merge_with_match(row)
+        if self.action == 'Done':
+            self.action = SkipAction(self)
+        else:
+            self.action = UpdateAction(self, self.sfid)
+
 
 class SerializedStockSpace(RecordSpace):
+    __slots__ = []
+
     def __init__(self, record, ser_stock):
         super(SerializedStockSpace, self).__init__(
             record, 'SVMXC__Product_Serial__c')
@@ -91,7 +125,7 @@ class SerializedStockSpace(RecordSpace):
             k: v for k, v in ser_stock.items()
             if k in ['Name']
             })
-        self.valid_fields.append('SVMXC__Active__c')
+        self.valid_fields.add('SVMXC__Active__c')
 
     def get_name(self):
         return self.Name
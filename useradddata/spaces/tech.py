@@ -14,6 +14,9 @@ TECH_DEFAULTS = {
 
 
 class TechSpace(RecordSpace):
+    __slots__ = []
+    requires = ('user', 'sites')
+
     def __init__(self, record):
         self.matching_terms = ['Name']
         super(TechSpace, self).__init__(
@@ -50,6 +50,8 @@ FIELDS_FROM_REF = [
 
 
 class UserSpace(RecordSpace):
+    __slots__ = []
+
     def __init__(self, parent):
         if not isinstance(getattr(parent, 'ref', None), RecordSpace):
             raise RuntimeError('Record has no reference space.')
@@ -60,7 +62,7 @@ class UserSpace(RecordSpace):
         expected_terms = ['Username', 'SSO__c']
         self.matching_terms.extend(
             [x for x in expected_terms if getattr(self, x) is not None])
-        self.valid_fields.extend([x for x in USER_DEFAULTS.keys()])
+        self.valid_fields.update(USER_DEFAULTS.keys())
 
     def get_name(self):
         fallback = 'unnamed user'
@@ -1,7 +1,32 @@
 from . import main
+from . import metrics
 from . import configurator
-# import pytest
+from . import connections
+from . import decisions
+from . import journal
+from . import lookups
+from . import reportstore
+from . import plan
+from . import querycache
+from . import ratelimit
+from . import record
+from . import results
+from . import scheduler
+from . import snapshot
+from . import validation
+from .spaces import RecordSpace
+from .spaces import bulk
+from .spaces.actions import DoneAction, InsertAction, UpdateAction
+from .spaces.serials import SerialDiff
+from .spaces.stock import SiteStock
+from .bench.fakeforce import FakeForce, FakeOrg, LocalConnection
+from .bench.reports import fake_id
+import pytest
 import os
+import subprocess
+import sys
+import threading
+import types
 
 
 def test_config_file_path():
@@ -22,3 +47,486 @@ def test_get_records():
 def test_read_user_add_report():
     report = main.read_user_add_report()
     assert isinstance(report, dict)
+
+
+def test_report_store_reloads_changed_file(tmp_path):
+    report = tmp_path / 'report.json'
+    report.write_text('{"results": [{"a": {"name": "Key", "value": "1"}}]}')
+    store = reportstore.ReportStore(
+        lambda name: str(report), main.import_json_dict)
+    assert len(store.lookup('ser_stock', 'Key', '1')) == 1
+    report.write_text(
+        '{"results": [{"a": {"name": "Key", "value": "2"}},'
+        ' {"a": {"name": "Key", "value": "2"}}]}')
+    assert store.lookup('ser_stock', 'Key', '1') == []
+    assert len(store.lookup('ser_stock', 'Key', '2')) == 2
+
+
+def test_iter_json_dict_filters_while_streaming(tmp_path):
+    report = tmp_path / 'report.json'
+    report.write_text(
+        '{"count": 2, "results": ['
+        '{"a": {"name": "Key", "type": "RAW", "value": "6b31"}},'
+        '{"a": {"name": "Key", "type": "RAW", "value": "6b32"}}]}')
+    rows = main.iter_json_dict(
+        str(report), where=main.field_equals('Key', 'k2'))
+    assert [x for x in rows] == [{'Key': 'k2'}]
+    rows = main.import_json_dict(str(report))
+    assert rows == [{'Key': 'k1'}, {'Key': 'k2'}]
+
+
+def test_decode_rows_matches_decode_row():
+    recs = [
+        {'a': {'name': 'A', 'type': 'RAW', 'value': '6b00'},
+         'b': {'name': 'B', 'value': 1}},
+        {'a': {'name': 'A', 'type': 'RAW', 'value': None},
+         'b': {'name': 'B', 'value': 2}},
+        {'a': {'name': 'A', 'type': 'RAW', 'value': 'c3a9'},
+         'b': {'name': 'B', 'type': 'VARCHAR2', 'value': 3}}]
+    assert main.decode_rows(recs) == [main.decode_row(x) for x in recs]
+
+
+def test_plan_blocks_steps_after_failed_link():
+    steps = [
+        {'id': 'a:0', 'sfid': None, 'status': 'failed', 'links': {}},
+        {'id': 'a:1', 'sfid': None, 'status': 'planned',
+         'links': {'AssigneeId': 'a:0'}}]
+    assert plan.Plan(steps=steps).ready_steps() == []
+    assert steps[1]['status'] == 'blocked'
+
+
+def test_query_cache_remembers_empty_results_until_invalidated():
+    calls = []
+    key = ('test', 'soql', 'User', ('Id',), ())
+
+    def query():
+        calls.append(1)
+        return []
+    querycache.cached(key, 'User', query)
+    querycache.cached(key, 'User', query)
+    assert len(calls) == 1
+    querycache.invalidate(sobject='User')
+    querycache.cached(key, 'User', query)
+    assert len(calls) == 2
+
+
+def test_offline_lazy_record_builds_nothing_up_front():
+    row = {'a': {'name': 'Environment', 'value': 'Prod'}}
+    lazy = record.LazyRecord(row, offline=True)
+    assert 'user' not in lazy.__dict__
+    assert lazy.conn is None
+    assert lazy.ref.Environment == 'Prod'
+
+
+def test_record_space_stores_each_field_once():
+    space = RecordSpace(None, 'Account', Name='a')
+    space.fields_from_dict({'Name': 'b', 'Site': 'c'})
+    space.excluded.add('Site')
+    assert list(space.fields) == ['Name', 'Site']
+    assert space.Name == 'b'
+    assert space.to_dict() == {'Name': 'b'}
+
+
+def test_scheduler_skips_tasks_whose_roles_failed():
+    ran = []
+
+    def task(role, requires, ok=True):
+        return scheduler.Task(
+            role, lambda: ran.append(role) or ok, requires)
+    succeeded = scheduler.run_tasks([
+        task('user', []),
+        task('sites', ['user'], False),
+        task('technician', ['user', 'sites'])])
+    assert succeeded == {'user'}
+    assert ran == ['user', 'sites']
+
+
+def test_metrics_export_counters_and_histograms():
+    metrics.reset()
+    metrics.inc('rest_calls_total', kind='query', sobject='User')
+    metrics.inc('rest_calls_total', kind='query', sobject='User')
+    metrics.observe('rest_call_seconds', 0.02, kind='query')
+    text = metrics.to_prometheus()
+    metrics.reset()
+    assert 'rest_calls_total{kind="query",sobject="User"} 2' in text
+    assert 'rest_call_seconds_bucket{kind="query",le="0.01"} 0' in text
+    assert 'rest_call_seconds_bucket{kind="query",le="0.025"} 1' in text
+    assert 'rest_call_seconds_count{kind="query"} 1' in text
+
+
+def test_limiter_retries_pushback_and_keeps_reserve():
+    class Response():
+        def __init__(self, status_code, limit_info=''):
+            self.status_code = status_code
+            self.headers = {'Sforce-Limit-Info': limit_info}
+    answers = [Response(503), Response(200, 'api-usage=95/100')]
+    limiter = ratelimit.Limiter('test', pause=0, check_every=0)
+    assert limiter.run(None, lambda: answers.pop(0)).status_code == 200
+    assert (limiter.used, limiter.allowed) == (95, 100)
+    try:
+        limiter.run(None, lambda: Response(200))
+        assert False
+    except ratelimit.ApiLimitReached:
+        pass
+
+
+def test_journal_keeps_last_entry_and_skips_cut_lines(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    path.write_text('\n'.join([
+        '{"row": "1", "env": "prod", "finished": false, "roles": []}',
+        '{"row": "1", "env": "prod", "finished": true, "roles": ["user"]}',
+        '{"row": "2", "env": "prod", "finished": true, "roles": ["user"]}',
+        '{"row": "2", "env": "prod", "fin']))
+    loaded = journal.Journal(str(path)).load()
+    assert loaded.finished_rows() == {('1', 'prod'), ('2', 'prod')}
+
+
+def test_row_results_skip_only_unchanged_finished_rows(tmp_path):
+    rows = results.RowResults(str(tmp_path / 'result.json'))
+    first = results.row_fingerprint({'Username': 'a', 'Alias': 'b'})
+    assert first == results.row_fingerprint({'Alias': 'b', 'Username': 'a'})
+    rows.note('1', 'prod', first, 'finished')
+    rows.note('2', 'prod', first, 'incomplete')
+    loaded = results.RowResults(rows.save()).load()
+    assert loaded.unchanged('1', 'prod', first)
+    assert not loaded.unchanged('1', 'prod', 'changed')
+    assert not loaded.unchanged('2', 'prod', first)
+
+
+def test_result_sink_rotates_by_size(tmp_path):
+    path = str(tmp_path / 'result.ndjson')
+    sink = results.ResultSink(path, flush_every=1, max_bytes=30).open()
+    for idx in range(2):
+        sink.write({'row': str(idx), 'outcome': 'finished'})
+    sink.close()
+    assert open(path + '.2').read() == '{"row":"0","outcome":"finished"}\n'
+    assert open(path + '.1').read() == '{"row":"1","outcome":"finished"}\n'
+    assert open(path).read() == ''
+
+
+def test_sync_serials_fails_when_a_serial_insert_fails(monkeypatch):
+    class Diff():
+        def spaces(self):
+            return ['inserted', 'rejected']
+
+        def summary(self):
+            return '2 serials to insert'
+    monkeypatch.setattr(record, 'reconcile_serials', lambda r, d: Diff())
+    monkeypatch.setattr(record, 'take_actions', lambda spaces: spaces[:1])
+    tech = RecordSpace(None, 'SVMXC__Service_Group_Members__c', name='Tech')
+    fake = types.SimpleNamespace(technician=tech)
+    assert record.Record.sync_serials(fake) is False
+
+
+def test_journal_keeps_earlier_runs_when_not_resuming(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    first = journal.Journal(path).open()
+    first.append({'row': '1', 'env': 'prod', 'finished': True, 'roles': []})
+    first.close()
+    journal.Journal(path).open().close()
+    assert journal.Journal(path).load().finished_rows() == {('1', 'prod')}
+
+
+def test_writes_forget_only_the_lookups_of_written_rows():
+    loader = lookups.get_loader(object(), 'User', 'Username', ['Id'])
+    loader.results = {
+        'written@x': (querycache.expires('User', []), []),
+        'other@x': (querycache.expires('User', []), [])}
+    querycache.invalidate(
+        sobject='User', rows=[{'Id': '005x', 'Username': 'Written@x'}])
+    assert list(loader.results.keys()) == ['other@x']
+
+
+def test_force_def_announces_only_id_values(monkeypatch):
+    wanted = []
+    monkeypatch.setattr(validation, 'get_connection', lambda env: 'conn')
+    monkeypatch.setattr(
+        lookups, 'want_one', lambda *args: wanted.append(args[1:4]))
+    desc = validation.ForceDef(sobject='TestObject__c', fields=[])
+    desc.defs['prod'] = [
+        {'name': 'ProfileId', 'soapType': 'tns:ID',
+         'referenceTo': ['Profile'], 'referenceTargetField': None},
+        {'name': 'Name', 'soapType': 'xsd:string'}]
+    desc.pulled.add('prod')
+    desc.want_ids('Prod', {
+        'ProfileId': '00e000000000001AAA', 'Name': '00e000000000002'})
+    desc.want_ids('prod', {'ProfileId': 'not an id'})
+    assert wanted == [('Profile', 'Id', '00e000000000001AAA')]
+
+
+def test_loader_retries_failed_chunk_one_value_at_a_time(monkeypatch):
+    queries = []
+
+    class SOQL():
+        def __init__(self, conn, fields, sobject, filters):
+            queries.append(filters[0])
+            if "'bad'" in filters[0]:
+                raise RuntimeError('MALFORMED_QUERY')
+            self.rows = [{'Id': '01t000000000001', 'Name': 'good'}]
+
+        def get_results(self):
+            return self.rows
+
+    class Never(Exception):
+        pass
+    monkeypatch.setattr(lookups.sf, 'SOQL', SOQL)
+    monkeypatch.setattr(lookups, 'ratelimit', types.SimpleNamespace(
+        ApiLimitReached=Never,
+        limited=lambda conn, kind, sobject, call: call()))
+    loader = lookups.LookupLoader(None, 'Product2', 'Name', ['Id'])
+    loader.want('bad')
+    assert len(loader.load('good')) == 1
+    assert len(queries) == 3
+    id_loader = lookups.LookupLoader(None, 'Product2', 'Id', ['Id'])
+    assert id_loader.load("01t' OR Name != '") == []
+    assert len(queries) == 3
+
+
+def test_snapshot_indexes_every_field_when_asked(tmp_path, monkeypatch):
+    report = tmp_path / 'locations.json'
+    report.write_text(
+        '{"results": [{"a": {"name": "Number", "value": "1"},'
+        ' "b": {"name": "City", "value": "Ulm"}}]}')
+    store = snapshot.SnapshotReport(
+        'locations', str(report), main.iter_json_dict,
+        ['Number', snapshot.ALL_FIELDS])
+    monkeypatch.setattr(snapshot.SnapshotReport, 'rows', None)
+    assert store.lookup('City', 'Ulm') == [{'Number': '1', 'City': 'Ulm'}]
+    assert store.lookup('City', 'Pune') == []
+
+
+def test_collections_stop_when_the_api_reserve_is_reached(monkeypatch):
+    def limited(conn, kind, sobject, call):
+        raise ratelimit.ApiLimitReached('dev', 90, 100)
+    monkeypatch.setattr(bulk.ratelimit, 'limited', limited)
+    with pytest.raises(ratelimit.ApiLimitReached):
+        bulk.insert_records(None, 'Account', [{'Name': 'a'}])
+
+
+def test_default_policy_chooses_the_site_with_the_location_number():
+    policy = decisions.DecisionPolicy(**decisions.DEFAULT_POLICY)
+    sites = [
+        {'Location_Number__c': '2001', 'Oracle_Ship_to_Number__c': '1001'},
+        {'Location_Number__c': '1001', 'Oracle_Ship_to_Number__c': '1001'}]
+    ref = {'Oracle_Location_Number': '1001'}
+    assert policy.choose('choose_site', sites, ref) == 1
+
+
+def test_force_def_describes_once_while_others_wait(monkeypatch):
+    force_def = validation.ForceDef(sobject='TestObject__c', fields=[])
+    started = threading.Event()
+    release = threading.Event()
+    pulls = []
+
+    def pull_force_def(env):
+        pulls.append(env)
+        started.set()
+        release.wait(5)
+        force_def.pulled.add(env)
+    force_def.pull_force_def = pull_force_def
+    first = threading.Thread(target=force_def.ensure_env, args=('dev',))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=force_def.ensure_env, args=('dev',))
+    second.start()
+    second.join(0.1)
+    assert second.is_alive()
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert not second.is_alive()
+    assert pulls == ['dev']
+
+
+@pytest.fixture
+def fake_org():
+    org = FakeOrg(records={})
+    server = FakeForce(org, {}).start()
+    yield (org, server, LocalConnection(server.url))
+    server.stop()
+
+
+class ReadySpace(RecordSpace):
+    """Space that needs no describe to be sent"""
+    __slots__ = []
+
+    def want_validation(self):
+        pass
+
+    def validate(self):
+        self.valid = True
+
+
+def ready_space(conn, sobject, **fields):
+    return ReadySpace(types.SimpleNamespace(conn=conn), sobject, **fields)
+
+
+def test_take_actions_sets_ids_from_collections_over_200(fake_org):
+    org, server, conn = fake_org
+    spaces = [
+        ready_space(conn, 'Account', Name='a%d' % x) for x in range(201)]
+    for space in spaces:
+        space.action = InsertAction(space)
+    assert len(bulk.take_actions(spaces)) == 201
+    assert server.calls['collection'] == 2
+    inserted = org.records['Account']
+    assert [x.sfid for x in spaces] == [x['Id'] for x in inserted]
+    assert all(isinstance(x.action, DoneAction) for x in spaces)
+
+
+def test_take_actions_fails_only_the_records_the_org_refused(fake_org):
+    org, server, conn = fake_org
+    org.records['Account'] = [{'Id': fake_id('001', 1), 'Name': 'a'}]
+    spaces = [
+        ready_space(conn, 'Account', Name='b'),
+        ready_space(conn, 'Account', Name='c')]
+    spaces[0].action = UpdateAction(spaces[0], fake_id('001', 1))
+    spaces[1].action = UpdateAction(spaces[1], fake_id('001', 2))
+    assert bulk.take_actions(spaces) == spaces[:1]
+    assert org.records['Account'][0]['Name'] == 'b'
+    assert spaces[0].action.success and spaces[0].sfid == fake_id('001', 1)
+    assert not spaces[1].action.success
+
+
+def test_serial_diff_inserts_reactivates_and_deactivates():
+    stock_id = fake_id('a0P', 1)
+    org = FakeOrg(records={'SVMXC__Product_Serial__c': [
+        {'Id': fake_id('a0Q', x), 'Name': name, 'SVMXC__Active__c': active,
+         'SVMXC__Product_Stock__c': stock_id}
+        for x, (name, active) in enumerate([
+            ('S1', True), ('S2', False), ('S3', True)])]})
+    rows = org.query(
+        "SELECT Id, Name, SVMXC__Active__c FROM SVMXC__Product_Serial__c "
+        "WHERE SVMXC__Product_Stock__c = '%s'" % stock_id)['records']
+    conn = types.SimpleNamespace(auth={'instance_url': 'https://bench'})
+    stock = types.SimpleNamespace(
+        sfid=stock_id,
+        SVMXC__Product__c=fake_id('01t', 1),
+        wanted_serials=lambda: ['s1', 'S2', 'S4'])
+    diff = SerialDiff(types.SimpleNamespace(conn=conn), deactivate=True)
+    diff.compare(stock, rows)
+    assert [x[1].Name for x in diff.inserts] == ['S4']
+    assert [x[1].sfid for x in diff.reactivations] == [fake_id('a0Q', 1)]
+    assert diff.reactivations[0][1].SVMXC__Active__c is True
+    assert [x[1].sfid for x in diff.deactivations] == [fake_id('a0Q', 2)]
+    assert diff.deactivations[0][1].SVMXC__Active__c is False
+
+
+def test_site_stock_loads_stock_and_serials_in_one_query(fake_org):
+    org, server, conn = fake_org
+    site_id = fake_id('a0L', 1)
+    org.records['SVMXC__Product_Stock__c'] = [
+        {'Id': fake_id('a0P', x), 'SVMXC__Product__c': fake_id('01t', x),
+         'SVMXC__Quantity2__c': 1, 'SVMXC__Status__c': 'Available',
+         'SVMXC__Location__c': site} for x, site in enumerate(
+            [site_id, site_id, fake_id('a0L', 2)])]
+    org.records['SVMXC__Product_Serial__c'] = [
+        {'Id': fake_id('a0Q', 1), 'Name': 'S1', 'SVMXC__Active__c': True,
+         'SVMXC__Product_Stock__c': fake_id('a0P', 0)}]
+    site_stock = SiteStock(conn, site_id).load()
+    assert server.calls['query'] == 1
+    assert len(site_stock.stock) == 2
+    found = site_stock.find_stock(fake_id('01t', 1)[:15], 'Available')
+    assert found['Id'] == fake_id('a0P', 1)
+    assert site_stock.find_stock(fake_id('01t', 2), 'Available') is None
+    assert [x['Name'] for x in site_stock.find_serials(
+        fake_id('a0P', 0))] == ['S1']
+    assert site_stock.find_serials(fake_id('a0P', 1)) == []
+
+
+def test_serial_diff_skips_stock_that_failed_to_insert():
+    conn = types.SimpleNamespace(auth={'instance_url': 'https://bench'})
+    site_stock = SiteStock(conn, fake_id('a0L', 1))
+    stocks = [
+        types.SimpleNamespace(
+            sfid=sfid,
+            SVMXC__Product__c=fake_id('01t', 1),
+            wanted_serials=lambda: ['S1', 'S2'])
+        for sfid in [None, fake_id('a0P', 1)]]
+    diff = SerialDiff(types.SimpleNamespace(
+        conn=conn, stock=stocks, site_stock=site_stock)).compute()
+    assert [x[0] for x in diff.inserts] == [stocks[1], stocks[1]]
+
+
+def test_rerun_matches_existing_site_and_technician_by_name(monkeypatch):
+    policy = decisions.DecisionPolicy(
+        **{**decisions.DEFAULT_POLICY, 'interactive': False})
+    monkeypatch.setattr(decisions, '_policy', policy)
+    for sobject in ['SVMXC__Site__c', 'SVMXC__Service_Group_Members__c']:
+        space = RecordSpace(None, sobject, Name='Ana Ng - TRUNK STOCK')
+        matches = [
+            {'Id': fake_id('a0L', 1), 'Name': 'Ana Ng - TRUNK STOCK'},
+            {'Id': fake_id('a0L', 2), 'Name': 'Ana Ng'}]
+        assert space.choose_match(matches) == matches[0]
+
+
+def test_expired_session_signs_in_again_and_retries_once(monkeypatch):
+    conn = types.SimpleNamespace(auth={'access_token': 'old'})
+    monkeypatch.setitem(connections._envs, id(conn), 'dev')
+    monkeypatch.setattr(connections.sf, 'Connection', lambda env: (
+        types.SimpleNamespace(auth={'access_token': 'new'})))
+    expired = [{'errorCode': 'INVALID_SESSION_ID'}]
+    tokens = []
+
+    def call():
+        tokens.append(conn.auth['access_token'])
+        return expired if conn.auth['access_token'] == 'old' else 'ok'
+    assert ratelimit.limited(conn, 'query', 'User', call) == 'ok'
+    assert tokens == ['old', 'new']
+    monkeypatch.setattr(connections.sf, 'Connection', lambda env: (
+        types.SimpleNamespace(auth={'access_token': 'old'})))
+    conn.auth = {'access_token': 'old'}
+    assert ratelimit.limited(conn, 'query', 'User', call) == expired
+
+
+def test_snapshot_workers_decode_without_importing_main():
+    assert main.iter_json_dict.__module__ == 'useradddata.decoding'
+    found = subprocess.run(
+        [sys.executable, '-c',
+         'import sys, useradddata.decoding; '
+         'print("useradddata.main" in sys.modules)'],
+        cwd=os.path.dirname(os.path.dirname(main.__file__)),
+        capture_output=True, text=True, check=True)
+    assert found.stdout.strip() == 'False'
+
+
+def test_report_store_closes_stale_snapshots(tmp_path):
+    report = tmp_path / 'report.json'
+    report.write_text('{"results": [{"a": {"name": "Key", "value": "1"}}]}')
+    store = reportstore.ReportStore(
+        lambda name: str(report), main.import_json_dict,
+        streamer=main.iter_json_dict, modes={'ser_stock': 'snapshot'})
+    old = store.get_report('ser_stock')
+    report.write_text(
+        '{"results": [{"a": {"name": "Key", "value": "1"}},'
+        ' {"a": {"name": "Key", "value": "1"}}]}')
+    assert len(store.lookup('ser_stock', 'Key', '1')) == 2
+    assert old.conn is None
+    store.clear()
+    assert store.reports == {}
+
+
+def test_plan_apply_fills_links_and_blocks_steps_without_ids(
+        fake_org, monkeypatch):
+    org, server, conn = fake_org
+    monkeypatch.setitem(connections._connections, 'bench', conn)
+    monkeypatch.setitem(connections._envs, id(conn), 'bench')
+
+    def step(sid, sobject, status='planned', links=None):
+        return {
+            'id': sid, 'env': 'bench', 'sobject': sobject,
+            'action': 'insert', 'sfid': None, 'payload': {},
+            'links': {} if links is None else links, 'status': status,
+            'error': None}
+    steps = [
+        step('a:0', 'User'),
+        step('a:1', 'PermissionSetAssignment', links={'AssigneeId': 'a:0'}),
+        step('a:2', 'SVMXC__Site__c', 'done'),
+        step('a:3', 'SVMXC__Service_Group_Members__c',
+             links={'SVMXC__Inventory_Location__c': 'a:2'})]
+    plan.Plan(steps=steps).apply()
+    assert [x['status'] for x in steps] == [
+        'done', 'done', 'done', 'blocked']
+    assignment = org.records['PermissionSetAssignment'][0]
+    assert assignment['AssigneeId'] == steps[0]['sfid']
+    assert steps[3]['error'] == 'A step it depends on is done without an Id.'
@@ -1,11 +1,33 @@
 import os
+import copy
 import json
-import force as sf
+import atexit
+import threading
 from datetime import datetime
+from . import lookups
+from . import metrics
+from . import ratelimit
+from . import querycache
+from concurrent.futures import ThreadPoolExecutor
+from .connections import format_env, get_connection
+from .decisions import get_policy
+from .paths import data_folder, write_atomic
+
+
+ENVIRONMENTS = ['production', 'trainusers', 'uat', 'itest', 'integr']
+
+
+SPACE_SOBJECTS = [
+    'User',
+    'PermissionSetAssignment',
+    'SVMXC__Site__c',
+    'SVMXC__Service_Group_Members__c',
+    'SVMXC__Product_Stock__c',
+    'SVMXC__Product_Serial__c']
 
 
 def get_rules_folder():
-    folder = os.path.dirname(__file__)
+    folder = data_folder()
     return os.path.join(folder, 'validation_rules')
 
 
@@ -24,8 +46,49 @@ def get_saved_rules():
     return saved
 
 
-def format_env(given):
-    return ''.join(given.split(' ')).lower()
+_force_defs = {}
+_force_defs_lock = threading.Lock()
+
+
+def get_force_def(sobject, fields):
+    """Process-wide ForceDef for sobject, read from disk once per run"""
+    with _force_defs_lock:
+        force_def = _force_defs.get(sobject, None)
+        if force_def is None:
+            force_def = ForceDef(sobject=sobject, fields=fields)
+            _force_defs[sobject] = force_def
+        return force_def
+
+
+def flush_force_defs():
+    """Writes every cached ForceDef whose rules changed"""
+    with _force_defs_lock:
+        force_defs = [x for x in _force_defs.values()]
+    for force_def in force_defs:
+        force_def.flush()
+
+
+atexit.register(flush_force_defs)
+
+
+def warm_force_defs(sobjects, envs=None, max_workers=8):
+    """Describes many sobjects across environments at once.
+
+    sobjects maps an sobject to the fields to keep, or is a list of
+    sobjects; with no fields every described field is kept.
+    """
+    if not isinstance(sobjects, dict):
+        sobjects = {x: [] for x in sobjects}
+    envs = ENVIRONMENTS if envs is None else [format_env(x) for x in envs]
+    force_defs = [get_force_def(k, v) for k, v in sobjects.items()]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(x.ensure_env, env)
+            for x in force_defs for env in envs]
+        for future in futures:
+            future.result()
+    flush_force_defs()
+    return force_defs
 
 
 class ForceDef():
@@ -44,21 +107,46 @@ class ForceDef():
     def __init__(self, **kwargs):
         self.sobject = kwargs['sobject']
         init_fields = [{'name': x} for x in kwargs['fields']]
-        init_fields = [{**x, **self.DEFAULTS} for x in init_fields]
-        envs = ['production', 'trainusers', 'uat', 'itest', 'integr']
-        self.defs = {x: [f for f in init_fields] for x in envs}
+        self.init_fields = [{**x, **self.DEFAULTS} for x in init_fields]
+        self.defs = {
+            x: copy.deepcopy(self.init_fields) for x in ENVIRONMENTS}
         self.file_name = '%s.json' % self.sobject
         self.file_path = os.path.join(get_rules_folder(), self.file_name)
+        self.dirty = False
+        self.lock = threading.RLock()
+        self.pulled = set()
+        self.attempted = {}
         self.get_defs()
 
     def get_defs(self):
+        """Loads saved rules; environments are described on first use"""
         if self.open_defs():
+            self.pulled = {
+                k for k, v in self.defs.items()
+                if any(x.get('soapType', None) is not None for x in v)}
+        return
+
+    def ensure_env(self, env):
+        """Describes env unless it was described before or tried this run.
+
+        Callers that come while another thread describes env wait for it.
+        """
+        env = format_env(env)
+        with self.lock:
+            if env in self.pulled:
+                return
+            described = self.attempted.get(env, None)
+            if described is None:
+                self.attempted[env] = threading.Event()
+                if env not in self.defs:
+                    self.defs[env] = copy.deepcopy(self.init_fields)
+        if described is not None:
+            described.wait()
             return
-        for env in self.defs.keys():
+        try:
             self.pull_force_def(env)
-        with open(self.file_path, 'w') as f:
-            json.dump(self.defs, f, indent=3)
-        return
+        finally:
+            self.attempted[env].set()
 
     def open_defs(self):
         if os.path.isfile(self.file_path):
@@ -68,12 +156,18 @@ class ForceDef():
         return False
 
     def save_defs(self):
-        with open(self.file_path, 'w') as f:
-            json.dump(self.defs, f, indent=3)
-        return        
+        with self.lock:
+            write_atomic(self.file_path, json.dumps(self.defs, indent=3))
+            self.dirty = False
+        return
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.save_defs()
 
     def force_def_connection(self, env):
-        conn = sf.Connection(env)
+        conn = get_connection(env)
         if 'error' in conn.auth.keys():
             print("%s connection error: %s: %s" % (
                 env, conn.auth['error'], conn.auth['error_description']))
@@ -86,24 +180,63 @@ class ForceDef():
         conn, url = self.force_def_connection(env)
         if conn is None:
             return
-        response = conn.req_get(url)
-        response_fields = response.get('fields', [])
-        defined = []
-        while len(self.defs[env]) > 0:
-            field = self.defs[env].pop(0)
-            mtch = [
-                x for x in response_fields if x['name'] == field['name']]
-            if len(mtch) > 0:
-                force_version = {
-                    k: v for k, v in mtch[0].items() if k in field.keys()}
-                field = {**field, **force_version}
-            defined.append(field)
-        self.defs[env] = [x for x in defined]
+        response = ratelimit.limited(
+            conn, 'describe', self.sobject, lambda: conn.req_get(url))
+        response_fields = {x['name']: x for x in response.get('fields', [])}
+        with self.lock:
+            fields = self.defs.get(env, [])
+            if len(fields) == 0:
+                fields = [
+                    {**copy.deepcopy(self.DEFAULTS), 'name': x}
+                    for x in response_fields.keys()]
+            defined = []
+            for field in fields:
+                mtch = response_fields.get(field['name'], None)
+                if mtch is not None:
+                    force_version = {
+                        k: v for k, v in mtch.items() if k in field.keys()}
+                    field = {**field, **force_version}
+                defined.append(field)
+            self.defs[env] = defined
+            if len(response_fields) > 0:
+                self.pulled.add(env)
+                self.dirty = True
         return
 
+    def want_ids(self, env, to_check):
+        """Announces the Id values of to_check to the batch lookups.
+
+        Validating a group of spaces then checks each referenced sobject
+        with one IN query instead of one query per value.
+        """
+        env = format_env(env)
+        self.ensure_env(env)
+        conn = get_connection(env)
+        rules = {x['name']: x for x in self.defs.get(env, [])}
+        for field, value in to_check.items():
+            rule = rules.get(field, None)
+            if rule is None or not lookups.is_id(value):
+                continue
+            if (rule.get('soapType', None) or '').split(':')[-1] != 'ID':
+                continue
+            if value in rule.get('tested_values', {}):
+                continue
+            target = rule.get('referenceTargetField', None) or 'Id'
+            for sobject in rule.get('referenceTo', None) or [self.sobject]:
+                lookups.want_one(conn, sobject, target, value, ['Id'])
+
     def check_values(self, env, to_check, first=True):
         env = format_env(env)
+        with metrics.timer(
+                'check_values_seconds', sobject=self.sobject, env=env):
+            return self.check_env_values(env, to_check, first)
+
+    def check_env_values(self, env, to_check, first=True):
+        self.ensure_env(env)
+        conn = get_connection(env)
         rules = {x['name']: x for x in self.defs[env]}
+        tested = {
+            k: dict(v.get('tested_values', {})) for k, v in rules.items()}
         good = {}
         fixable = {}
         unfixable = {}
@@ -114,7 +247,7 @@ class ForceDef():
             val_type = rules[field]['soapType'].split(':')[-1]
             val_args = {
                 'env': env,
-                'conn': sf.Connection(env),
+                'conn': conn,
                 'sobject': self.sobject,
                 'given': to_check[field],
                 'desc': rules[field]}
@@ -129,25 +262,45 @@ class ForceDef():
             if validation.valid:
                 good[field] = validation.given
             elif first:
-                print('"%s" invalid for %s.%s. (%s).' % (
-                    validation.given,
-                    self.sobject,
-                    field,
-                    '; '.join(validation.problems)))
-                fixable[field] = input('Enter new value:')
+                fixed = self.ask_fix(env, field, validation)
+                if fixed is None:
+                    unfixable[field] = (
+                        validation.given,
+                        validation.problems)
+                else:
+                    fixable[field] = fixed
             else:
                 unfixable[field] = (
                     validation.given,
                     validation.problems)
             rules[field]['tested_values'] = validation.tested_values
-        self.defs[env] = [v for k, v in rules.items()]
-        self.save_defs()
+        with self.lock:
+            self.defs[env] = [v for k, v in rules.items()]
+            if any(v.get('tested_values', {}) != tested.get(k, {})
+                   for k, v in rules.items()):
+                self.dirty = True
         if len(fixable.keys()) > 0:
-            second = self.check_values(env, fixable, False)
+            second = self.check_env_values(env, fixable, False)
             good = {**good, **second[0]}
             unfixable = {**unfixable, **second[1]}
         return (good, unfixable)
 
+    def ask_fix(self, env, field, validation):
+        def prompt():
+            print('"%s" invalid for %s.%s. (%s).' % (
+                validation.given,
+                self.sobject,
+                field,
+                '; '.join(validation.problems)))
+            return input('Enter new value:')
+        context = {
+            'env': env,
+            'sobject': self.sobject,
+            'field': field,
+            'given': validation.given,
+            'problems': validation.problems}
+        return get_policy().value('fix_value', context, prompt, skip=True)
+
 
 class FieldValidation():
     def __init__(self, **kwargs):
@@ -249,7 +402,6 @@ class BooleanValidation(FieldValidation):
 class IdValidation(FieldValidation):
     def __init__(self, **kwargs):
         super(IdValidation, self).__init__(**kwargs)
-        self.conn = sf.Connection(self.env)
 
     def local_validate(self):
         if not isinstance(self.given, str):
@@ -263,14 +415,12 @@ class IdValidation(FieldValidation):
 
     def match_field(self, sobject, field='name'):
         rtn = []
-        filt = "%s='%s'" % (field, self.given)
         try:
-            query = sf.SOQL(
-                self.conn,
-                sobject=sobject,
-                filters=[filt])
             rtn.extend([
-                x['Id'] for x in query.get_results()])
+                x['Id'] for x in lookups.load_one(
+                    self.conn, sobject, field, self.given, ['Id'])])
+        except ratelimit.ApiLimitReached:
+            raise
         except Exception as e:
             pass
         return rtn
@@ -279,10 +429,10 @@ class IdValidation(FieldValidation):
         rtn = []
         try:
             rtn.extend([
-                x[sobject[1]] for x in sf.SOSL(
-                    self.conn,
-                    sobject=sobject[0],
-                    terms=[self.given]).get_results()])
+                x[sobject[1]] for x in querycache.sosl(
+                    self.conn, [self.given], sobject[0])])
+        except ratelimit.ApiLimitReached:
+            raise
         except Exception as e:
             pass
         return rtn
@@ -299,7 +449,7 @@ class IdValidation(FieldValidation):
         matched_names = []
         ref_obj_field = self.reference_obj_field()
         for ref in ref_obj_field:
-            matched_names.extend(self.match_field(ref))
+            matched_names.extend(self.match_field(ref[0]))
         if len(matched_names) > 0:
             return matched_names
         for ref in ref_obj_field:
@@ -315,4 +465,13 @@ class IdValidation(FieldValidation):
 
 
 if __name__ == '__main__':
-    pass
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Describe sobjects ahead of a run.')
+    parser.add_argument('sobjects', nargs='*', default=SPACE_SOBJECTS)
+    parser.add_argument('--env', action='append', dest='envs')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    for force_def in warm_force_defs(args.sobjects, args.envs, args.workers):
+        print('%s: %s' % (
+            force_def.sobject, ', '.join(sorted(force_def.pulled))))